@@ -10,6 +10,9 @@ from util import configs, importing, log
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--export-html")
+parser.add_argument(
+  "--profile-startup", action="store_true", help="输出每个插件的加载时间和内存占用后退出",
+)
 args = parser.parse_args()
 
 bot_config: Dict[str, Any] = {}
@@ -20,9 +23,15 @@ if os.path.exists("configs/nonebot.yaml"):
 log.init()
 nonebot.init(**bot_config, apscheduler_autostart=True)
 nonebot.get_driver().register_adapter(Adapter)
-importing.load_plugins()
+profiles = importing.load_plugins(args.profile_startup)
 
-if args.export_html:
+if args.profile_startup:
+  for i in sorted(profiles, key=lambda x: x.seconds, reverse=True):
+    print(f"{i.seconds * 1000:10.1f} ms {i.memory / 1024:8.1f} MiB  {i.name}")
+  total_seconds = sum(i.seconds for i in profiles)
+  total_memory = sum(i.memory for i in profiles)
+  print(f"{total_seconds * 1000:10.1f} ms {total_memory / 1024:8.1f} MiB  总计")
+elif args.export_html:
   from util import help, permission
   commands = help.CategoryItem.ROOT.html(False)
   index = help.export_index_html()
@@ -1,8 +1,8 @@
 import asyncio
+import math
 import time
-from collections import deque
 from datetime import datetime, timedelta
-from typing import Any, AsyncGenerator, Deque, Dict, List, Optional, Tuple, cast
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple, cast
 
 import nonebot
 from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, JobEvent
@@ -11,7 +11,7 @@ from nonebot.adapters.onebot.v11 import Bot, Event, Message, MessageSegment
 from nonebot.exception import ActionFailed
 from nonebot.params import CommandArg
 
-from util import command, context
+from util import command, context, misc
 from util.api_common import bilibili_activity
 
 from . import common, contents
@@ -20,15 +20,17 @@ nonebot.require("nonebot_plugin_apscheduler")
 from nonebot_plugin_apscheduler import scheduler  # noqa: E402
 
 driver = nonebot.get_driver()
-queue: Deque[common.User] = deque()
+tokens = 0.0
+tokens_time = 0.0
+format_semaphore = asyncio.Semaphore(1)
 
 
 @common.CONFIG.onload()
 def onload(prev: Optional[common.Config], curr: common.Config) -> None:
-  global queue
-  queue = deque()
-  for i in curr.users:
-    queue.append(i)
+  global tokens_time, format_semaphore
+  tokens_time = 0
+  # 同时格式化的动态数，防止一次推送很多动态时同时下载大量图片
+  format_semaphore = asyncio.Semaphore(max(curr.concurrency, 1))
   schedule(datetime.now() + timedelta(seconds=curr.interval))
 
 
@@ -58,6 +60,12 @@ async def on_bot_connect() -> None:
   common.CONFIG()
 
 
+@driver.on_shutdown
+async def on_shutdown() -> None:
+  if bilibili_activity.GRPC_AVAILABLE:
+    await bilibili_activity.grpc_close()
+
+
 async def new_activities(
   user: common.User,
 ) -> AsyncGenerator[bilibili_activity.Activity[object, object], None]:
@@ -84,6 +92,67 @@ async def new_activities(
     offset = next_offset
 
 
+def get_stats(uid: int) -> common.UserStats:
+  state = common.STATE()
+  if (stats := state.users.get(uid, None)) is None:
+    stats = state.users[uid] = common.UserStats()
+  return stats
+
+
+def prune_stats() -> None:
+  # 取消订阅的UP主的统计数据不再需要，保存前删掉，防止状态文件无限增长
+  uids = {user.uid for user in common.CONFIG().users}
+  state = common.STATE()
+  for uid in [uid for uid in state.users if uid not in uids]:
+    del state.users[uid]
+
+
+def estimate_rate(stats: common.UserStats, times: List[int], now: float) -> None:
+  # 第一次检查时用最近的动态估计频率，之后用保存的数据
+  if not stats.last_check and times:
+    half_life = common.CONFIG().rate_half_life
+    stats.rate = len(times) / max(now - min(times), half_life / 10)
+  stats.last_check = now
+
+
+def update_rate(stats: common.UserStats, count: int, now: float) -> None:
+  # 指数加权，稳定后等于实际的频率
+  if stats.last_check:
+    half_life = common.CONFIG().rate_half_life
+    decay = 0.5 ** ((now - stats.last_check) / half_life)
+    stats.rate = stats.rate * decay + count * math.log(2) / half_life
+  stats.last_check = now
+
+
+def priority(user: common.User, now: float) -> Tuple[bool, float]:
+  # 先检查太久没检查的，再按估计的新动态数量从多到少检查
+  config = common.CONFIG()
+  stats = get_stats(user.uid)
+  if (user._offset == "-1" and config.grpc) or not stats.last_check:
+    return True, math.inf
+  elapsed = now - stats.last_check
+  rate = max(stats.rate, config.min_rate / 86400)
+  return elapsed >= config.max_lag, rate * elapsed
+
+
+def select_users() -> List[common.User]:
+  global tokens, tokens_time
+  config = common.CONFIG()
+  if config.rate_limit <= 0:
+    return list(config.users)
+  now = time.time()
+  burst = max(1.0, config.rate_limit * config.interval)
+  if tokens_time:
+    tokens = min(burst, tokens + (now - tokens_time) * config.rate_limit)
+  else:
+    tokens = burst
+  tokens_time = now
+  users = sorted(config.users, key=lambda user: priority(user, now), reverse=True)
+  users = users[:int(tokens)]
+  tokens -= len(users)
+  return users
+
+
 async def try_check(bot: Bot, user: common.User) -> int:
   async def try_send(
     activity: bilibili_activity.Activity[object, object], message: Message,
@@ -109,28 +178,36 @@ async def try_check(bot: Bot, user: common.User) -> int:
       except ActionFailed:
         pass
 
-  async def try_send_all(activity: bilibili_activity.Activity[object, object]) -> None:
-    logger.info(f"推送 {user._name}({user.uid}) 的动态 {activity.id}")
+  async def try_format(activity: bilibili_activity.Activity[object, object]) -> Optional[Message]:
     try:
-      message = await contents.format(activity)
+      async with format_semaphore:
+        return await contents.format(activity)
     except common.IgnoredException as e:
       logger.info(f"已忽略 {user._name}({user.uid}) 的动态 {activity.id}: {e}")
-      return
+      return None
     except Exception:
       logger.exception((
         f"格式化 {user._name}({user.uid}) 的动态 {activity.id} 失败！\n"
         f"动态内容: {activity}"
       ))
-      message = Message(MessageSegment.text((
+      return Message(MessageSegment.text((
         f"{user._name} 更新了一条动态，但在推送时格式化消息失败。"
         f"https://t.bilibili.com/{activity.id}"
       )))
+
+  async def try_send_all(
+    activity: bilibili_activity.Activity[object, object], message: Message,
+  ) -> None:
+    logger.info(f"推送 {user._name}({user.uid}) 的动态 {activity.id}")
     await asyncio.gather(*[try_send(activity, message, target) for target in user.targets])
 
+  stats = get_stats(user.uid)
   if user._offset == "-1" and common.CONFIG().grpc:
     try:
       raw, _ = await bilibili_activity.grpc_fetch(user.uid)
       activities = [bilibili_activity.Activity.grpc_parse(x) for x in raw]
+      times = [x.time for x in activities if x.time is not None and not x.top]
+      estimate_rate(stats, times, time.time())
       if len(activities) > 1:
         user._offset = str(max(int(activities[0].id), int(activities[1].id)))
       elif activities:
@@ -142,6 +219,7 @@ async def try_check(bot: Bot, user: common.User) -> int:
       logger.success(f"初始化 {user._name}({user.uid}) 的动态推送完成 {user._offset}")
     except Exception:
       logger.exception(f"初始化 {user.uid} 的动态推送失败")
+      stats.last_check = time.time()
     return 0
 
   try:
@@ -149,30 +227,39 @@ async def try_check(bot: Bot, user: common.User) -> int:
     async for activity in new_activities(user):
       activities.append(activity)
     activities.reverse()
-    for activity in activities:
+    # 同时下载图片和渲染所有新动态，再按顺序推送
+    messages = await asyncio.gather(*[try_format(activity) for activity in activities])
+    for activity, message in zip(activities, messages):
       user._offset = activity.id
-      await try_send_all(activity)
-    user._time = time.time()
+      if message is not None:
+        await try_send_all(activity, message)
+      if activity.time is not None:
+        stats.last_delay = time.time() - activity.time
+    user._time = now = time.time()
+    update_rate(stats, len(activities), now)
     logger.debug(f"检查 {user._name}({user.uid}) 的动态更新完成")
     return len(activities)
   except Exception:
     logger.exception(f"检查 {user._name}({user.uid}) 的动态更新失败")
+    # 失败时也算作检查过，防止一直占用检查的机会
+    stats.last_check = time.time()
     return 0
 
 
 async def try_check_all(bot: Bot, concurrency: Optional[int] = None) -> Tuple[int, int]:
+  # 不指定时按速率限制选择，0 为检查所有UP主，正数为按优先级检查指定数量的UP主
   if concurrency is None:
-    concurrency = common.CONFIG().concurrency
-  queue_ = queue
-  if concurrency == 0:
-    users = list(queue_)
-    queue_.clear()
+    users = select_users()
+  elif concurrency == 0:
+    users = list(common.CONFIG().users)
   else:
-    users = []
-    while queue_ and len(users) < concurrency:
-      users.append(queue_.popleft())
+    now = time.time()
+    users = sorted(common.CONFIG().users, key=lambda user: priority(user, now), reverse=True)
+    users = users[:concurrency]
   results = await asyncio.gather(*[try_check(bot, user) for user in users])
-  queue_.extend(users)
+  if users:
+    prune_stats()
+    common.STATE.dump()
   return len([x for x in results if x]), sum(results)
 
 
@@ -228,3 +315,37 @@ async def handle_check_now(bot: Bot):
     await check_now.finish(f"检查动态更新完成，推送了 {users} 个UP主的 {activities} 条动态。")
   else:
     await check_now.finish("检查动态更新完成，没有可推送的内容。")
+
+
+check_stats = (
+  command.CommandBuilder("bilibili_activity.stats", "动态统计")
+  .level("admin")
+  .brief("查看B站动态的检查情况")
+  .usage((
+    "按检查顺序显示每个UP主估计的发动态频率、距离上次检查的时间和最近一条动态的推送延迟，"
+    "以及 gRPC 接口的调用次数和耗时"
+  ))
+  .build()
+)
+@check_stats.handle()
+async def handle_check_stats() -> None:
+  now = time.time()
+  users = sorted(common.CONFIG().users, key=lambda user: priority(user, now), reverse=True)
+  if not users:
+    await check_stats.finish("没有订阅的UP主")
+  segments = []
+  for user in users:
+    stats = get_stats(user.uid)
+    lag = misc.format_time(now - stats.last_check) or "0 秒" if stats.last_check else "从未检查"
+    delay = "无" if stats.last_delay is None else misc.format_time(stats.last_delay) or "0 秒"
+    segments.append(
+      f"{user._name}({user.uid}) 频率 {stats.rate * 86400:.2f} 条/天 距上次检查 {lag} "
+      f"推送延迟 {delay}",
+    )
+  for method, grpc_stats in bilibili_activity.grpc_stats().items():
+    average = grpc_stats.seconds / grpc_stats.calls if grpc_stats.calls else 0
+    segments.append(
+      f"gRPC {method} 调用 {grpc_stats.calls} 次 失败 {grpc_stats.errors} 次 "
+      f"平均 {average * 1000:.0f} 毫秒 最长 {grpc_stats.max_seconds * 1000:.0f} 毫秒",
+    )
+  await check_stats.finish("\n".join(segments))
@@ -1,12 +1,12 @@
 import asyncio
 import time
 from io import BytesIO
-from typing import List, Optional, Pattern, Union
+from typing import Dict, List, Optional, Pattern, Union
 
 from PIL import Image, ImageOps
 from pydantic import BaseModel, Field, PrivateAttr
 
-from util import configs, misc
+from util import configs, user_aliases
 from util.api_common.bilibili_activity import GRPC_AVAILABLE
 
 
@@ -33,6 +33,11 @@ class Config(BaseModel):
   grpc_: bool = Field(True, alias="grpc")
   interval_: Optional[int] = Field(None, alias="interval")
   concurrency_: Optional[int] = Field(None, alias="concurrency")
+  # 每秒最多检查的UP主数，默认为 concurrency / interval，0 为每次检查所有UP主
+  rate_limit_: Optional[float] = Field(None, alias="rate_limit")
+  max_lag: int = 3600  # 秒，超过这么久没检查的UP主最先检查
+  min_rate: float = 1  # 条/天，估计的发动态频率低于这个值时按这个值算
+  rate_half_life: int = 7 * 24 * 3600  # 秒，估计发动态频率时旧数据的半衰期
   users: List[User] = Field(default_factory=list)
   ignore_regexs: List[Pattern[str]] = Field(default_factory=list)
   ignore_forward_regexs: List[Pattern[str]] = Field(default_factory=list)
@@ -54,8 +59,25 @@ class Config(BaseModel):
       return 5 if self.grpc else 1
     return self.concurrency_
 
+  @property
+  def rate_limit(self) -> float:
+    if self.rate_limit_ is None:
+      return self.concurrency / self.interval
+    return self.rate_limit_
+
+
+class UserStats(BaseModel):
+  rate: float = 0  # 估计的发动态频率，条/秒
+  last_check: float = 0
+  last_delay: Optional[float] = None  # 最近一条动态从发布到推送的时间
+
+
+class State(BaseModel):
+  users: Dict[int, UserStats] = Field(default_factory=dict)
+
 
 CONFIG = configs.SharedConfig("bilibili_activity", Config, "eager")
+STATE = configs.SharedState("bilibili_activity", State)
 IMAGE_GAP = 10
 
 
@@ -70,8 +92,9 @@ def check_ignore(content: str):
 
 
 async def fetch_image(url: str) -> Image.Image:
-  async with misc.http().get(url) as response:
-    return ImageOps.exif_transpose(Image.open(BytesIO(await response.read())))
+  # 经过共享的图片缓存，同一个UP主的头像和重复推送的封面不用重新下载
+  data = await user_aliases.download_image_data(url)
+  return ImageOps.exif_transpose(Image.open(BytesIO(data)))
 
 
 async def fetch_images(*urls: str) -> List[Image.Image]:
@@ -24,7 +24,10 @@
 #       DYNAMIC_TYPE_SUBSCRIPTION
 # 4311: DYNAMIC_TYPE_SUBSCRIPTION_NEW
 
-from typing import Any, Awaitable, Callable, List, Tuple, Type, TypeVar
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Tuple, Type, TypeVar
 
 from nonebot.adapters.onebot.v11 import Message, MessageSegment
 
@@ -65,8 +68,35 @@ FORMATTERS: List[Formatter[Any]] = [
 ]
 
 
-async def format(activity: Activity[object, object], can_ignore: bool = True) -> Message:
+CACHE_SIZE = 64
+CACHE_TTL = 600
+# 动态号 -> (时间, 是否检查过忽略规则, 消息)
+_cache: "OrderedDict[str, Tuple[float, bool, Message]]" = OrderedDict()
+_tasks: "Dict[Tuple[str, bool], asyncio.Task[Message]]" = {}
+
+
+async def format_uncached(activity: Activity[object, object], can_ignore: bool) -> Message:
   for type, formatter in FORMATTERS:
     if isinstance(activity.content, type):
-      return await formatter(activity, can_ignore)
-  return await format_unknown(activity)
+      message = await formatter(activity, can_ignore)
+      break
+  else:
+    message = await format_unknown(activity)
+  _cache[activity.id] = (time.monotonic(), can_ignore, message)
+  _cache.move_to_end(activity.id)
+  while len(_cache) > CACHE_SIZE:
+    _cache.popitem(False)
+  return message
+
+
+# 缓存渲染好的消息，强制推送、重试和同时检查到的同一条动态只渲染一次
+async def format(activity: Activity[object, object], can_ignore: bool = True) -> Message:
+  cached = _cache.get(activity.id, None)
+  if cached and time.monotonic() - cached[0] < CACHE_TTL and (cached[1] or not can_ignore):
+    _cache.move_to_end(activity.id)
+    return Message(cached[2])
+  key = (activity.id, can_ignore)
+  if (task := _tasks.get(key, None)) is None:
+    task = _tasks[key] = asyncio.create_task(format_uncached(activity, can_ignore))
+    task.add_done_callback(lambda _: _tasks.pop(key, None))
+  return Message(await asyncio.shield(task))
@@ -17,6 +17,7 @@ from util.command import CommandBuilder
 from util.dateutil import DATE_ARGS_USAGE, parse_date_range_args
 from util.material_color import source_color_from_image
 from util.material_color.hct import Hct
+from util.material_color.palettes import tonal_palette
 
 
 class Config(BaseModel):
@@ -63,30 +64,31 @@ async def handle_statistics(
 
   today = date.today()
   if style == "year":
-    date_func = func.date(record.Received.time, "start of month")
+    date_func = func.date(record.DailyCount.day, "start of month")
     if today.month == 12:
       begin_time = date(today.year, 1, 1)
     else:
       begin_time = date(today.year - 1, today.month + 1, 1)
   elif style == "github":
-    date_func = func.date(record.Received.time)
+    date_func = func.date(record.DailyCount.day)
     begin_time = today - timedelta(today.weekday() + 52 * 7)
   else:
-    date_func = func.date(record.Received.time)
+    date_func = func.date(record.DailyCount.day)
     begin_time = today - timedelta(31)
-  async with AsyncSession(record.engine) as session:
+  async with AsyncSession(record.read_engine) as session:
     query = select(
       date_func,
-      func.count(date_func),
+      func.sum(record.DailyCount.count),
     )
     if group_id != -1:
-      query = query.where(record.Received.group_id == group_id)
+      query = query.where(record.DailyCount.group_id == group_id)
     if is_user:
-      query = query.where(record.Received.user_id == user_id)
+      query = query.where(record.DailyCount.user_id == user_id)
     result = await session.execute(
       query
-      .where(record.Received.time >= begin_time)
-      .group_by(date_func),
+      .where(record.DailyCount.day >= begin_time)
+      .group_by(date_func)
+      .order_by(date_func),
     )
     result = result.all()
 
@@ -96,19 +98,19 @@ async def handle_statistics(
       name, group, avatar = await asyncio.gather(
         context.get_card_or_name(bot, group_id, user_id),
         bot.get_group_info(group_id=group_id),
-        imutil.get_avatar(user_id),
+        imutil.get_avatar(user_id, size=100),
       )
       title = f"{name} 在 {group['group_name']} 群内的{title}"
     else:
       name, avatar = await asyncio.gather(
         context.get_card_or_name(bot, group_id, user_id),
-        imutil.get_avatar(user_id),
+        imutil.get_avatar(user_id, size=100),
       )
       title = f"{name} 的{title}"
   else:
     group, avatar = await asyncio.gather(
       bot.get_group_info(group_id=group_id),
-      imutil.get_avatar(gid=group_id),
+      imutil.get_avatar(gid=group_id, size=100),
     )
     title = f"{group['group_name']} 群内的{title}"
 
@@ -137,7 +139,7 @@ async def handle_statistics(
     imutil.paste(im, thu_im, (weekdays_w - 8, header_h + 30 * 3 + 11), anchor="rm")
     imutil.paste(im, sun_im, (weekdays_w - 8, header_h + 30 * 6 + 11), anchor="rm")
     hct = Hct.from_argb(source_color_from_image(avatar.resize((64, 64), Image.Resampling.LANCZOS)))
-    color1 = colorutil.split_rgb(int(Hct(hct.hue, max(hct.chroma, 48), 70)))
+    color1 = colorutil.split_rgb(tonal_palette(hct.hue, max(hct.chroma, 48)).tone(70))
     color2 = (235, 237, 240)
     x = im.width - 8
     y = im.height - 8 - minmax_h / 2
@@ -252,12 +254,13 @@ class BarPalette:
     hct = Hct.from_argb(source_color_from_image(im))
     self.hue = hct.hue
     self.chroma = max(48, hct.chroma)
+    self.palette = tonal_palette(self.hue, self.chroma)
     self.fg = self[40]
     self.bar = self[70]
     self.bg = self[95]
 
   def __getitem__(self, tone: int) -> colorutil.RGB:
-    return colorutil.split_rgb(int(Hct(self.hue, self.chroma, tone)))
+    return colorutil.split_rgb(self.palette.tone(tone))
 
 
 leaderboard = (
@@ -273,17 +276,17 @@ async def handle_leaderboard(bot: Bot, event: MessageEvent, arg: Message = Comma
   config = CONFIG()
   group_id = context.get_event_context(event)
 
-  async with AsyncSession(record.engine) as session:
+  async with AsyncSession(record.read_engine) as session:
     result = await session.execute(
       select(
-        record.Received.user_id,
-        count_func := func.count(col(record.Received.user_id)),
+        record.DailyCount.user_id,
+        count_func := func.sum(record.DailyCount.count),
       )
-      .group_by(col(record.Received.user_id))
+      .group_by(col(record.DailyCount.user_id))
       .where(
-        record.Received.group_id == group_id,
-        record.Received.time >= start_datetime,
-        record.Received.time < end_datetime,
+        record.DailyCount.group_id == group_id,
+        record.DailyCount.day >= start_datetime.date(),
+        record.DailyCount.day < end_datetime.date(),
       )
       .order_by(desc(count_func))
       .limit(config.leaderboard_limit),
@@ -296,7 +299,7 @@ async def handle_leaderboard(bot: Bot, event: MessageEvent, arg: Message = Comma
 
   names, avatars, group = await asyncio.gather(
     asyncio.gather(*(context.get_card_or_name(bot, event, uid) for uid, _ in result)),
-    asyncio.gather(*(imutil.get_avatar(uid, bg=True) for uid, _ in result)),
+    asyncio.gather(*(imutil.get_avatar(uid, bg=True, size=100) for uid, _ in result)),
     bot.get_group_info(group_id=group_id),
   )
   end_datetime -= timedelta(seconds=1)  # 显示 23:59:59 而不是 00:00:00，以防误会
@@ -348,3 +351,17 @@ async def handle_leaderboard(bot: Bot, event: MessageEvent, arg: Message = Comma
     return imutil.to_segment(im)
 
   await leaderboard.finish(await misc.to_thread(make))
+
+
+rebuild = (
+  CommandBuilder("charts.rebuild", "重建统计")
+  .level("super")
+  .brief("从消息记录重建统计数据")
+  .usage("统计和排行使用按天汇总的发言数，数据有误时可以使用此命令从消息记录重新生成")
+  .build()
+)
+@rebuild.handle()
+async def handle_rebuild() -> None:
+  await rebuild.send("正在重建统计数据，可能需要一段时间")
+  await record.rebuild_daily_counts()
+  await rebuild.finish("已重建统计数据")
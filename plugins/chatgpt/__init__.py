@@ -10,7 +10,6 @@ from aiohttp import ClientSession
 from loguru import logger
 from nonebot.adapters.onebot.v11 import Message, MessageEvent, MessageSegment
 from nonebot.params import CommandArg
-from playwright.async_api import async_playwright
 from pydantic import BaseModel
 
 from util import command, configs, context, misc, permission
@@ -183,12 +182,9 @@ async def get_response(
 
 async def render_markdown(content: str) -> MessageSegment:
   config = CONFIG()
-  async with async_playwright() as p:
-    browser = await misc.launch_playwright(p)
-    page = await browser.new_page(
-      viewport={"width": config.image_width, "height": 1},
-      device_scale_factor=config.image_scale,
-    )
+  async with misc.acquire_page(
+    viewport={"width": config.image_width, "height": 1}, scale=config.image_scale,
+  ) as page:
     await page.goto(URL)
     await page.evaluate("render", content)
     data = await page.screenshot(full_page=True)
@@ -31,18 +31,17 @@ class RankModule(Module):
       return []
     today = date.today()
     yesterday = today - timedelta(1)
-    async with AsyncSession(record.engine) as session:
+    async with AsyncSession(record.read_engine) as session:
       result = await session.execute(
         select(
-          record.Received.user_id,
-          count_func := func.count(col(record.Received.user_id)),
+          record.DailyCount.user_id,
+          count_func := func.sum(record.DailyCount.count),
         )
         .where(
-          record.Received.group_id == self.group_id,
-          record.Received.time >= yesterday,
-          record.Received.time < today,
+          record.DailyCount.group_id == self.group_id,
+          record.DailyCount.day == yesterday,
         )
-        .group_by(col(record.Received.user_id))
+        .group_by(col(record.DailyCount.user_id))
         .order_by(desc(count_func))
         .limit(self.limit),
       )
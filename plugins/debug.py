@@ -170,3 +170,21 @@ async def handle_reload():
     if config.reloadable:
       config.reload()
   await reload.finish("已重载所有配置")
+
+migrate_states = (
+  command.CommandBuilder("debug.migrate_states", "迁移状态", "migrate_states")
+  .level("super")
+  .brief("转换状态文件的存储格式")
+  .usage('''\
+/迁移状态
+把 states 中的 YAML 文件转换到 misc.yaml 中 state_storage 设置的格式
+原来的 YAML 文件不会被删除''')
+  .build())
+
+
+@migrate_states.handle()
+async def handle_migrate_states():
+  if misc.CONFIG().state_storage == "yaml":
+    await migrate_states.finish("当前的存储格式就是 YAML")
+  count = configs.migrate_states()
+  await migrate_states.finish(f"已转换 {count} 个状态文件")
@@ -2,7 +2,6 @@ import math
 from argparse import Namespace
 from typing import Any, List
 
-import cv2
 import numpy as np
 from nonebot.adapters.onebot.v11 import Bot, MessageEvent, MessageSegment
 from nonebot.params import ShellCommandArgs
@@ -61,6 +60,7 @@ async def handle_erode(
     target_task = g(args.target, DefaultType.TARGET, raw=True)
 
   def make() -> MessageSegment:
+    import cv2  # 导入很慢，第一次使用时再导入
     target, _ = target_task.result()
     kernel = get_kernel(args.x, args.y)
 
@@ -91,6 +91,7 @@ async def handle_dilate(
     target_task = g(args.target, DefaultType.TARGET, raw=True)
 
   def make() -> MessageSegment:
+    import cv2  # 导入很慢，第一次使用时再导入
     target, _ = target_task.result()
     kernel = get_kernel(args.x, args.y)
 
@@ -3,7 +3,6 @@ from pathlib import Path
 from typing import Any, Dict, List
 
 import cairo
-import cv2
 import numpy as np
 from nonebot.adapters.onebot.v11 import Bot, MessageEvent, MessageSegment
 from nonebot.params import ShellCommandArgs
@@ -54,6 +53,7 @@ def make_mask(
     im = im.filter(ImageFilter.Kernel((3, 3), [1] * 9, 9))
 
   # 因为PIL只支持3x3和5x5的卷积核，NumPy的卷积是一维的，要用OpenCV
+  import cv2  # 导入很慢，第一次使用时再导入
   im1 = Image.fromarray(cv2.filter2D(np.array(im), -1, KERNELS[kernel]))
   im = ImageChops.subtract(im, im1, 1, 128)
 
@@ -1,10 +1,10 @@
 import math
 import random
 from argparse import Namespace
-from concurrent.futures import Future, ProcessPoolExecutor
-from typing import List
+from typing import Any, List
 
-from nonebot.adapters.onebot.v11 import Bot, MessageEvent, MessageSegment
+import numpy as np
+from nonebot.adapters.onebot.v11 import Bot, MessageEvent
 from nonebot.params import ShellCommandArgs
 from nonebot.rule import ArgumentParser
 from PIL import Image, ImageOps
@@ -36,84 +36,62 @@ class PerlinNoise2D:
     random.shuffle(permutation)
     self.permutation = tuple(permutation) * 2
 
-  def __call__(self, x: float, y: float, octaves: int = 1) -> float:
-    if octaves > 1:
-      freq = 1
-      amp = 1
-      max = 0
-      total = 0
-      for i in range(octaves):
-        max += amp
-        total += self(x * freq, y * freq) * amp
-        freq *= 2
-        amp *= 0.5
-      return total / max
-
+  def grid(self, x: np.ndarray[Any, Any], y: np.ndarray[Any, Any]) -> np.ndarray[Any, Any]:
+    # 一次计算整个数组（只有一个八度）
+    perm = np.array(self.permutation)
     s = (x + y) * _F2
-    i = int(x + s)
-    j = int(y + s)
+    i = np.floor(x + s).astype(np.intp)
+    j = np.floor(y + s).astype(np.intp)
     t = (i + j) * _G2
     x0 = x - (i - t)
     y0 = y - (j - t)
 
-    if x0 > y0:
-      i1 = 1
-      j1 = 0
-    else:
-      i1 = 0
-      j1 = 1
+    i1 = (x0 > y0).astype(np.intp)
+    j1 = 1 - i1
 
     x1 = x0 - i1 + _G2
     y1 = y0 - j1 + _G2
     x2 = x0 + _G2 * 2.0 - 1.0
     y2 = y0 + _G2 * 2.0 - 1.0
 
-    perm = self.permutation
-    ii = int(i) % 256
-    jj = int(j) % 256
+    ii = i % 256
+    jj = j % 256
     gi0 = perm[ii + perm[jj]] % 12
     gi1 = perm[ii + i1 + perm[jj + j1]] % 12
     gi2 = perm[ii + 1 + perm[jj + 1]] % 12
 
-    tt = 0.5 - x0**2 - y0**2
-    if tt > 0:
-      g = _GRAD3[gi0]
-      noise = tt**4 * (g[0] * x0 + g[1] * y0)
-    else:
-      noise = 0.0
-
-    tt = 0.5 - x1**2 - y1**2
-    if tt > 0:
-      g = _GRAD3[gi1]
-      noise += tt**4 * (g[0] * x1 + g[1] * y1)
-
-    tt = 0.5 - x2**2 - y2**2
-    if tt > 0:
-      g = _GRAD3[gi2]
-      noise += tt**4 * (g[0] * x2 + g[1] * y2)
+    grad = np.array(_GRAD3)
+    noise = np.zeros_like(x0)
+    for gi, xn, yn in ((gi0, x0, y0), (gi1, x1, y1), (gi2, x2, y2)):
+      tt = 0.5 - xn**2 - yn**2
+      g = grad[gi]
+      noise += np.where(tt > 0, tt**4 * (g[..., 0] * xn + g[..., 1] * yn), 0.0)
 
     return noise * 70.0
 
 
 def marble(
-  noise: PerlinNoise2D, im: Image.Image, scale: float, amp: float, i: int,
+  noise: PerlinNoise2D, frames: List[Image.Image], scale: float, amp: float,
   resample: Image.Resampling,
-) -> Image.Image:
-  im = ImageOps.contain(im, (MAX_SIZE, MAX_SIZE), resample)
-  out = Image.new("RGBA", im.size)
-  px = im.load()
-  out_px = out.load()
-  phase = math.tau / FRAMES * i
-
-  for x in range(im.width):
-    for y in range(im.height):
-      angle = noise(x * scale, y * scale) * math.pi + math.pi
-      x1 = round(x + math.sin(angle + phase) * amp)
-      y1 = round(y + math.cos(angle + phase) * amp)
-      if x1 >= 0 and y1 >= 0 and x1 < im.width and y1 < im.height:
-        out_px[x, y] = px[x1, y1]
-
-  return out
+) -> List[Image.Image]:
+  frames = [ImageOps.contain(im, (MAX_SIZE, MAX_SIZE), resample) for im in frames]
+  ys, xs = np.indices((frames[0].height, frames[0].width))
+  # 噪声只和坐标有关，所有帧共用，每帧只有相位不同
+  angle = noise.grid(xs * scale, ys * scale) * math.pi + math.pi
+
+  result: List[Image.Image] = []
+  for i, im in enumerate(frames):
+    phase = math.tau / FRAMES * i
+    # np.rint 和 round 一样是四舍六入五成双
+    x1 = np.rint(xs + np.sin(angle + phase) * amp).astype(np.intp)
+    y1 = np.rint(ys + np.cos(angle + phase) * amp).astype(np.intp)
+    valid = (x1 >= 0) & (y1 >= 0) & (x1 < im.width) & (y1 < im.height)
+    src = np.asarray(im)
+    out = np.zeros_like(src)
+    out[valid] = src[y1[valid], x1[valid]]
+    result.append(Image.fromarray(out))
+
+  return result
 
 
 parser = ArgumentParser(add_help=False)
@@ -141,21 +119,21 @@ async def handler(bot: Bot, event: MessageEvent, args: Namespace = ShellCommandA
   async with AvatarGetter(bot, event) as g:
     target_task = g(args.target, DefaultType.TARGET, raw=True)
 
-  def make() -> MessageSegment:
-    target, _ = target_task.result()
-    im_scale = min(MAX_SIZE / target.width, MAX_SIZE / target.height, 1)
-    scale = SCALE / (target.width * im_scale)
-    amp = AMPLITUDE * target.width * im_scale
-    noise = PerlinNoise2D()
-    resample = imutil.scale_resample()
-
-    futures: List[Future[Image.Image]] = []
-    with ProcessPoolExecutor() as exec:
-      for i, raw in zip(range(FRAMES), imutil.sample_frames(target, FRAMETIME)):
-        im = raw.convert("RGBA")
-        futures.append(exec.submit(marble, noise, im, scale, amp, i, resample))
-    frames: List[Image.Image] = [future.result() for future in futures]
-
-    return imutil.to_segment(frames, FRAMETIME, afmt=args.format)
-
-  await matcher.finish(await misc.to_thread(make))
+  target, _ = target_task.result()
+  im_scale = min(MAX_SIZE / target.width, MAX_SIZE / target.height, 1)
+  scale = SCALE / (target.width * im_scale)
+  amp = AMPLITUDE * target.width * im_scale
+  noise = PerlinNoise2D()
+  resample = imutil.scale_resample()
+
+  def prepare() -> List[Image.Image]:
+    return [
+      raw.convert("RGBA") for _, raw in zip(range(FRAMES), imutil.sample_frames(target, FRAMETIME))
+    ]
+
+  frames = await misc.run_in_process(
+    event.user_id, marble, noise, await misc.to_thread(prepare), scale, amp, resample,
+  )
+  await matcher.finish(await misc.to_thread(
+    imutil.to_segment, frames, FRAMETIME, afmt=args.format,
+  ))
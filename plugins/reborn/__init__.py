@@ -3,7 +3,6 @@ from pathlib import Path
 from typing import Dict, List, Literal, Tuple
 
 from nonebot.adapters.onebot.v11 import MessageSegment
-from playwright.async_api import async_playwright
 from pydantic import BaseModel, TypeAdapter
 
 from util import command, misc
@@ -41,9 +40,7 @@ async def handle_reborn() -> None:
     regions = TypeAdapter(List[Region]).validate_json(f.read())
   region = random.choices(regions, [x.weight for x in regions])[0]
   msg = f"恭喜你投胎到了{CONTINENTS[region.continent]}的{region.display_name}"
-  async with async_playwright() as p:
-    browser = await misc.launch_playwright(p)
-    page = await browser.new_page()
+  async with misc.acquire_page() as page:
     await page.goto(URL)
     await page.evaluate("render", [list(region.position), region.name])
     data = await page.screenshot(full_page=True)
@@ -36,6 +36,7 @@ class Record:
       yield message_id
 
   async def is_caused_by(self, message_id: int, user_id: int) -> bool:
+    await record.flush()
     async with AsyncSession(record.engine) as session:
       result = await session.execute(select(cast(Any, record.Sent.caused_by)).where(
         record.Sent.message_id == message_id,
@@ -86,6 +87,7 @@ async def handle_recall_end(bot: Bot, event: GroupMessageEvent) -> None:
   begin_time = recall_dates[event.group_id, event.user_id]
   end_time = datetime.fromtimestamp(cast(Reply, event.reply).time + 1)
 
+  await record.flush()
   async with AsyncSession(record.engine) as session:
     result = await session.execute(select(
       record.Sent.message_id,
@@ -1,15 +1,17 @@
+import asyncio
+import hashlib
 import math
+import os
 import re
-import socket
-from contextlib import asynccontextmanager
+from functools import lru_cache
 from pathlib import Path
-from typing import AsyncIterator, Literal, Optional, cast
+from typing import Dict, Literal, Optional, Tuple, cast
 
+import nonebot
 from aiohttp.web import BaseRequest, Response, Server, ServerRunner, TCPSite
 from nonebot.adapters.onebot.v11 import Message, MessageSegment
 from nonebot.params import ArgStr, CommandArg
 from nonebot.typing import T_State
-from playwright.async_api import async_playwright
 from pydantic import BaseModel, PrivateAttr
 from pyzim.archive import Zim
 from pyzim.entry import ContentEntry
@@ -24,7 +26,9 @@ class Config(BaseModel):
   width: int = 800
   scale: float = 1
   use_opencc: bool = True
+  cache_size: int = 64 * 1024 * 1024  # 字节，0 为禁用截图缓存
   _archive: Optional[Zim] = PrivateAttr(None)
+  _checksum: Optional[str] = PrivateAttr(None)
 
   @property
   def archive(self) -> Zim:
@@ -32,12 +36,28 @@ class Config(BaseModel):
       self._archive = Zim.open(self.zim)
     return self._archive
 
+  @property
+  def checksum(self) -> str:
+    # ZIM 文件的最后 16 字节是整个文件的 MD5
+    if not self._checksum:
+      with open(self.zim, "rb") as f:
+        f.seek(-16, os.SEEK_END)
+        self._checksum = f.read(16).hex()
+    return self._checksum
+
 
 CONFIG = configs.SharedConfig("wikipedia", Config)
 DIR = Path(__file__).resolve().parent
 COMMON_SCRIPT_PATH = DIR / "common.js"
 OPENCC_SCRIPT_PATH = DIR / "opencc.js"
+CACHE_DIR = Path("states/wikipedia")
+HOST = "127.0.0.1"  # 只监听 IPv4 回环地址，避免 localhost 解析到 IPv6
 CHARSET_RE = re.compile(r";\s*charset=([^;]*)")
+driver = nonebot.get_driver()
+_runner: Optional[ServerRunner] = None
+_port = 0
+_server_lock = asyncio.Lock()
+_screenshot_tasks: "Dict[str, asyncio.Task[bytes]]" = {}
 
 
 def get_entry(archive: Zim, url: str) -> Optional[ContentEntry]:
@@ -67,38 +87,83 @@ async def handler(request: BaseRequest):
   return Response(body=entry.read(), content_type=mime, charset=charset)
 
 
-@asynccontextmanager
-async def autostop(site: TCPSite) -> AsyncIterator[None]:
-  await site.start()
+@lru_cache(None)
+def read_script(path: Path) -> str:
+  with open(path) as f:
+    return f.read()
+
+
+async def get_port() -> int:
+  # 整个进程共用一个服务器，第一次截图时启动，关闭机器人时停止
+  global _runner, _port
+  async with _server_lock:
+    if not _runner:
+      runner = ServerRunner(Server(handler))
+      await runner.setup()
+      site = TCPSite(runner, HOST, 0)
+      await site.start()
+      _runner = runner
+      _port = cast(Tuple[str, int], runner.addresses[0])[1]
+  return _port
+
+
+@driver.on_shutdown
+async def on_shutdown() -> None:
+  if _runner:
+    await _runner.cleanup()
+
+
+def read_cache(file: Path) -> Optional[bytes]:
   try:
-    yield
-  finally:
-    await site.stop()
+    data = file.read_bytes()
+  except FileNotFoundError:
+    return None
+  os.utime(file)  # 按最近使用时间淘汰
+  return data
+
+
+def write_cache(file: Path, data: bytes, limit: int) -> None:
+  CACHE_DIR.mkdir(parents=True, exist_ok=True)
+  tmp = file.with_suffix(".tmp")
+  tmp.write_bytes(data)
+  os.replace(tmp, file)
+  misc.evict_directory(str(CACHE_DIR), limit)
+
+
+async def render(
+  path: str, format: Literal["png", "jpeg"], quality: Optional[int], file: Optional[Path],
+) -> bytes:
+  config = CONFIG()
+  if file and (data := await misc.to_thread(read_cache, file)) is not None:
+    return data
+  port = await get_port()
+  async with misc.acquire_page(
+    viewport={"width": config.width, "height": 1}, scale=config.scale,
+  ) as page:
+    await page.goto(f"http://{HOST}:{port}/{path}")
+    await page.evaluate(read_script(COMMON_SCRIPT_PATH))
+    if config.use_opencc:
+      await page.evaluate(read_script(OPENCC_SCRIPT_PATH))
+    data = await page.screenshot(full_page=True, type=format, quality=quality)
+  if file:
+    await misc.to_thread(write_cache, file, data, config.cache_size)
+  return data
 
 
 async def screenshot(
   path: str, format: Literal["png", "jpeg"] = "png", quality: Optional[int] = None,
 ) -> bytes:
   config = CONFIG()
-  server = Server(handler)
-  runner = ServerRunner(server)
-  await runner.setup()
-  with socket.socket() as s:
-    s.bind(("", 0))
-    port = s.getsockname()[1]
-  site = TCPSite(runner, "localhost", port)
-  async with autostop(site), async_playwright() as p:
-    browser = await misc.launch_playwright(p)
-    page = await browser.new_page(
-      viewport={"width": config.width, "height": 1}, device_scale_factor=config.scale,
-    )
-    await page.goto(f"http://localhost:{port}/{path}")
-    with open(COMMON_SCRIPT_PATH) as f:
-      await page.evaluate(f.read())
-    if config.use_opencc:
-      with open(OPENCC_SCRIPT_PATH) as f:
-        await page.evaluate(f.read())
-    return await page.screenshot(full_page=True, type=format, quality=quality)
+  key = "\0".join(map(str, (
+    config.checksum, path, config.width, config.scale, config.use_opencc, format, quality,
+  )))
+  key = hashlib.sha1(key.encode()).hexdigest()
+  file = CACHE_DIR / f"{key}.{format}" if config.cache_size else None
+  # 合并同一个页面的并发请求
+  if (task := _screenshot_tasks.get(key, None)) is None:
+    task = _screenshot_tasks[key] = asyncio.create_task(render(path, format, quality, file))
+    task.add_done_callback(lambda _: _screenshot_tasks.pop(key, None))
+  return await asyncio.shield(task)
 
 
 wikipedia = (
@@ -1,26 +1,33 @@
+import asyncio
 import json
 import re
-from datetime import timedelta
-from typing import Any, Optional, Sequence, cast
+from collections import Counter
+from datetime import date, datetime, timedelta
+from typing import TYPE_CHECKING, Any, Generator, Optional, Sequence, Tuple, cast
 
 import emoji
 import nonebot
-import wordcloud
-from jieba import Tokenizer
-from jieba.analyse import default_tfidf
-from jieba.analyse.tfidf import TFIDF
+from loguru import logger
 from nonebot.adapters.onebot.v11 import Bot, Message, MessageEvent, MessageSegment
 from nonebot.matcher import Matcher
 from nonebot.params import CommandArg
 from nonebot.typing import T_State
 from pydantic import BaseModel
+from sqlalchemy import Executable, Index, Row
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlmodel import func, select
+from sqlmodel import Field as SQLField, col, delete, func, select
 
 from util import configs, context, imutil, misc, record
 from util.command import CommandBuilder
 from util.dateutil import DATE_ARGS_USAGE, parse_date_range_args
 
+if TYPE_CHECKING:
+  from jieba.analyse.tfidf import TFIDF
+
+nonebot.require("nonebot_plugin_apscheduler")
+from nonebot_plugin_apscheduler import scheduler  # noqa: E402
+
 
 class Config(BaseModel):
   font: Optional[str] = None
@@ -30,14 +37,19 @@ class Config(BaseModel):
   bg: int = 0xffffff
   # https://matplotlib.org/stable/tutorials/colors/colormaps.html
   fg: str = "viridis"
-  limit: int = 0
+  index_interval: float = 60
+  index_batch_size: int = 5000
   userdict_path: str = ""
   stopwords_path: str = ""
-  _tfidf: Optional[TFIDF] = None
+  _tfidf: Any = None
 
   @property
-  def tfidf(self) -> TFIDF:
+  def tfidf(self) -> "TFIDF":
     if self._tfidf is None:
+      # jieba 导入时就要加载词典，第一次用到时再导入
+      from jieba import Tokenizer
+      from jieba.analyse import default_tfidf
+      from jieba.analyse.tfidf import TFIDF
       if self.userdict_path or self.stopwords_path:
         self._tfidf = TFIDF()
         if self.userdict_path:
@@ -58,23 +70,152 @@ URL_RE = re.compile(r"(https?:\/\/(?:www\.|(?!www))[a-zA-Z0-9][a-zA-Z0-9-]+[a-zA
 
 driver = nonebot.get_driver()
 
-def format_wordcloud(messages: Sequence[str]) -> MessageSegment:
+
+class WordCount(record.SQLModel, table=True):
+  __table_args__ = (
+    Index("ix_wordcount_group_id_day", "group_id", "day"),
+    Index("ix_wordcount_user_id_day", "user_id", "day"),
+  )
+
+  day: date = SQLField(primary_key=True)
+  group_id: int = SQLField(primary_key=True)  # 私聊为 -1
+  user_id: int = SQLField(primary_key=True)
+  word: str = SQLField(primary_key=True)
+  count: int
+
+
+class WordCountProgress(record.SQLModel, table=True):
+  last_id: int = SQLField(primary_key=True)  # 已经分词的最后一条 Received 的 ID
+
+
+WordCountKey = Tuple[date, int, int, str]
+ReceivedRow = Row[Tuple[int, datetime, Optional[int], int, str]]
+_index_lock = asyncio.Lock()
+_index_ready = False  # 已经分词到最新的消息，之后每次只需要处理少量新消息
+_index_task: "Optional[asyncio.Task[None]]" = None
+
+
+def extract_text(content: str) -> str:
+  data: list[dict[str, Any]] = json.loads(content)
+  plain = " ".join([x["data"]["text"] for x in data if x["type"] == "text"]).strip()
+  for start in driver.config.command_start:
+    if start and plain.startswith(start):
+      return ""
+  plain = URL_RE.sub(" ", plain)
+  return emoji.replace_emoji(plain, " ")
+
+
+def count_words(rows: Sequence[ReceivedRow]) -> Counter[WordCountKey]:
+  tokenizer = CONFIG().tfidf.tokenizer
+  counts = Counter[WordCountKey]()
+  for _, time, group_id, user_id, content in rows:
+    day = time.date()
+    group_id = -1 if group_id is None else group_id
+    for word in tokenizer.cut(extract_text(content)):
+      # 与 TFIDF.extract_tags 一致，停用词在查询时再过滤，修改后不需要重建
+      if len(word.strip()) >= 2:
+        counts[day, group_id, user_id, word] += 1
+  return counts
+
+
+def _upsert_word_counts(counts: Counter[WordCountKey]) -> Generator[Executable, None, None]:
+  for chunk in misc.chunked(counts.items(), 150):
+    statement = insert(WordCount).values([
+      {"day": day, "group_id": group_id, "user_id": user_id, "word": word, "count": count}
+      for (day, group_id, user_id, word), count in chunk
+    ])
+    yield statement.on_conflict_do_update(
+      index_elements=[WordCount.day, WordCount.group_id, WordCount.user_id, WordCount.word],
+      set_={"count": col(WordCount.count) + statement.excluded["count"]},
+    )
+
+
+@record.before_archive
+async def update_index() -> None:
+  # 增量分词新的消息记录，同一个事务内更新进度，中断后不会重复计数
+  global _index_ready
+  async with _index_lock:
+    while True:
+      async with AsyncSession(record.engine) as session:
+        result = await session.execute(select(func.max(WordCountProgress.last_id)))
+        last_id = result.scalar() or 0
+        result = await session.execute(
+          select(
+            col(record.Received.id),
+            record.Received.time,
+            record.Received.group_id,
+            record.Received.user_id,
+            record.Received.content,
+          )
+          .where(col(record.Received.id) > last_id)
+          .order_by(col(record.Received.id))
+          .limit(CONFIG().index_batch_size),
+        )
+        rows = result.all()
+        if not rows:
+          _index_ready = True
+          return
+        for statement in _upsert_word_counts(await misc.to_thread(count_words, rows)):
+          await session.execute(statement)
+        await session.execute(delete(WordCountProgress))
+        session.add(WordCountProgress(last_id=rows[-1][0]))
+        await session.commit()
+
+
+async def rebuild_index() -> None:
+  global _index_ready
+  async with _index_lock:
+    _index_ready = False
+    async with record.engine.connect() as connection:
+      await connection.execute(delete(WordCount))
+      await connection.execute(delete(WordCountProgress))
+      await connection.commit()
+      table = record.ArchivedReceived
+      for path in record.get_archives():
+        async with record.attach_archive(connection, path):
+          last_id = 0
+          while True:
+            result = await connection.execute(
+              select(table.c.id, table.c.time, table.c.group_id, table.c.user_id, table.c.content)
+              .where(table.c.id > last_id)
+              .order_by(table.c.id)
+              .limit(CONFIG().index_batch_size),
+            )
+            rows = result.all()
+            if not rows:
+              break
+            for statement in _upsert_word_counts(await misc.to_thread(count_words, rows)):
+              await connection.execute(statement)
+            await connection.commit()
+            last_id = rows[-1][0]
+  await update_index()
+
+
+async def try_update_index() -> None:
+  await record.flush()
+  try:
+    await update_index()
+  except Exception:
+    logger.exception("更新词云索引失败")
+
+
+@driver.on_startup
+async def on_startup() -> None:
+  scheduler.add_job(
+    try_update_index, "interval", id="wordcloud_index", replace_existing=True,
+    seconds=CONFIG().index_interval,
+  )
+
+
+def format_wordcloud(counts: Sequence[Row[Tuple[str, int]]]) -> MessageSegment:
+  import wordcloud  # 会导入 matplotlib，很慢
   config = CONFIG()
-  texts: list[str] = []
-  for i in messages:
-    data: list[dict[str, Any]] = json.loads(i)
-    plain = " ".join([x["data"]["text"] for x in data if x["type"] == "text"]).strip()
-    is_command = False
-    for start in driver.config.command_start:
-      if start and plain.startswith(start):
-        is_command = True
-        break
-    if is_command:
-      continue
-    plain = URL_RE.sub(" ", plain)
-    plain = emoji.replace_emoji(plain, " ")
-    texts.append(plain)
-  tags = dict(cast(list[tuple[str, float]], config.tfidf.extract_tags("\n".join(texts), 0, True)))
+  tfidf = config.tfidf
+  words = [(word, count) for word, count in counts if word.lower() not in tfidf.stop_words]
+  total = sum(count for _, count in words)
+  tags = {
+    word: count * tfidf.idf_freq.get(word, tfidf.median_idf) / total for word, count in words
+  }
   wc = wordcloud.WordCloud(
     config.font,
     config.width,
@@ -106,31 +247,37 @@ personal_wordcloud = (
 async def handle_wordcloud(
   bot: Bot, event: MessageEvent, state: T_State, arg: Message = CommandArg(),
 ) -> None:
+  global _index_task
   start_datetime, end_datetime = await parse_date_range_args(arg)
-  config = CONFIG()
   group_id = context.get_event_context(event)
   user_id = event.user_id
   is_user = state["is_user"]
 
-  async with AsyncSession(record.engine) as session:
-    query = select(record.Received.content)
+  if _index_ready:
+    await try_update_index()
+  else:
+    # 第一次需要分词所有的历史消息，放在后台进行，不阻塞命令
+    if not _index_task or _index_task.done():
+      _index_task = asyncio.create_task(try_update_index())
+    await Matcher.finish("正在建立词云索引，请稍后再试")
+  async with AsyncSession(record.read_engine) as session:
+    query = select(WordCount.word, func.sum(WordCount.count))
     if group_id != -1:
-      query = query.where(record.Received.group_id == group_id)
+      query = query.where(WordCount.group_id == group_id)
     if is_user:
-      query = query.where(record.Received.user_id == user_id)
+      query = query.where(WordCount.user_id == user_id)
     result = await session.execute(
       query.where(
-        record.Received.time >= start_datetime,
-        record.Received.time < end_datetime,
+        WordCount.day >= start_datetime.date(),
+        WordCount.day < end_datetime.date(),
       )
-      .order_by(func.random())
-      .limit(None if config.limit == 0 else config.limit),
+      .group_by(col(WordCount.word)),
     )
-    messages = result.scalars().all()
+    counts = result.all()
 
   end_datetime -= timedelta(seconds=1)  # 显示 23:59:59 而不是 00:00:00，以防误会
   try:
-    seg = await misc.to_thread(format_wordcloud, messages)
+    seg = await misc.to_thread(format_wordcloud, counts)
   except ValueError:
     await Matcher.finish((
       f"{start_datetime:%Y-%m-%d %H:%M:%S} 到 {end_datetime:%Y-%m-%d %H:%M:%S} 内没有数据"
@@ -143,3 +290,18 @@ async def handle_wordcloud(
     group_info = await bot.get_group_info(group_id=group_id)
     title = f"{group_info['group_name']} 群内 {title}"
   await Matcher.finish(title + seg)
+
+
+rebuild = (
+  CommandBuilder("wordcloud.rebuild", "重建词云")
+  .level("super")
+  .brief("从消息记录重建词云数据")
+  .usage("修改用户词典后需要使用此命令重新分词，停用词的修改则不需要")
+  .build()
+)
+@rebuild.handle()
+async def handle_rebuild() -> None:
+  await rebuild.send("正在重建词云数据，可能需要一段时间")
+  await record.flush()
+  await rebuild_index()
+  await rebuild.finish("已重建词云数据")
@@ -5,7 +5,6 @@ from urllib.parse import quote as encodeuri
 import aiohttp
 from nonebot.adapters.onebot.v11 import Message, MessageSegment
 from nonebot.params import CommandArg
-from playwright.async_api import async_playwright
 from pydantic import BaseModel, Field
 
 from util import command, configs, misc
@@ -72,9 +71,7 @@ async def handle_wttr(arg: Message = CommandArg()):
     url = f"https://wttr.in/{encodeuri(city, '')}?lang={config.lang}"
     async with session.get(url) as response:
       content = await response.text()
-  async with async_playwright() as p:
-    browser = await misc.launch_playwright(p)
-    page = await browser.new_page(viewport={"width": 1, "height": 1})
+  async with misc.acquire_page(viewport={"width": 1, "height": 1}) as page:
     await page.goto(URL)
     await page.evaluate("render", [content.rstrip(), config.xterm])
     data = await page.screenshot(full_page=True)
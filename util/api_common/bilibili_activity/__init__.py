@@ -1,8 +1,11 @@
+import asyncio
 import json
+import time
+from contextlib import contextmanager
 from dataclasses import dataclass
 from typing import (
-  TYPE_CHECKING, Any, Dict, Generic, Iterable, List, Literal, Optional, Protocol, Sequence, Tuple,
-  Type, TypeVar, Union, cast, overload,
+  TYPE_CHECKING, Any, Dict, Generator, Generic, Iterable, List, Literal, Optional, Protocol,
+  Sequence, Tuple, Type, TypeVar, Union, cast, overload,
 )
 from urllib.parse import urlparse
 
@@ -52,13 +55,76 @@ GRPC_METADATA = (
   ('x-bili-metadata-bin', b'\x12\x07android\x1a\x05phone \x80\xe7\x8f\x03*\x04bili2%XY5ADF45C6BF3BD3FAE8126774BD8E4E7DFC5:\x07android'),  # noqa: E501
   ('x-bili-network-bin', b'\x08\x01'),
 )
+GRPC_OPTIONS = (
+  # 有请求时发送心跳，尽早发现断开的连接，间隔太短或者空闲时发送会被服务器以 too_many_pings 断开
+  ("grpc.keepalive_time_ms", 300000),
+  ("grpc.keepalive_timeout_ms", 10000),
+  ("grpc.keepalive_permit_without_calls", 0),
+  # 断开后由 gRPC 自动重连，失败时指数退避
+  ("grpc.initial_reconnect_backoff_ms", 1000),
+  ("grpc.max_reconnect_backoff_ms", 60000),
+)
+
+
+@dataclass
+class GrpcStats:
+  calls: int = 0
+  errors: int = 0
+  seconds: float = 0  # 总耗时
+  max_seconds: float = 0
+
+
+_channel: "Optional[grpc.aio.Channel]" = None
+_stub: "Optional[DynamicAsyncStub]" = None
+_grpc_stats: Dict[str, GrpcStats] = {}
+_detail_waiters: "Dict[str, List[asyncio.Future[DynamicItem]]]" = {}
+_detail_task: "Optional[asyncio.Task[None]]" = None
+
+
+def _get_stub() -> "DynamicAsyncStub":
+  # 所有请求共用一个连接，不用每次都进行 TLS 握手
+  global _channel, _stub
+  if _channel and _channel.get_state() == grpc.ChannelConnectivity.SHUTDOWN:
+    _channel = None
+  if not _channel or not _stub:
+    _channel = grpc.aio.secure_channel(GRPC_API, grpc.ssl_channel_credentials(), GRPC_OPTIONS)
+    _stub = cast("DynamicAsyncStub", DynamicStub(_channel))
+  return _stub
+
+
+async def grpc_close() -> None:
+  global _channel, _stub
+  if _channel:
+    await _channel.close()
+  _channel = None
+  _stub = None
+
+
+@contextmanager
+def _measure(method: str) -> Generator[None, None, None]:
+  if (stats := _grpc_stats.get(method, None)) is None:
+    stats = _grpc_stats[method] = GrpcStats()
+  begin = time.perf_counter()
+  try:
+    yield
+  except BaseException:
+    stats.errors += 1
+    raise
+  finally:
+    elapsed = time.perf_counter() - begin
+    stats.calls += 1
+    stats.seconds += elapsed
+    stats.max_seconds = max(stats.max_seconds, elapsed)
+
+
+def grpc_stats() -> Dict[str, GrpcStats]:
+  return {method: GrpcStats(**vars(stats)) for method, stats in _grpc_stats.items()}
 
 
 async def grpc_fetch(uid: int, offset: str = "") -> Tuple[Sequence["DynamicItem"], Optional[str]]:
-  async with grpc.aio.secure_channel(GRPC_API, grpc.ssl_channel_credentials()) as channel:
-    stub = cast("DynamicAsyncStub", DynamicStub(channel))
-    req = DynSpaceReq(host_uid=uid, history_offset=offset)
-    res = await stub.DynSpace(req)
+  req = DynSpaceReq(host_uid=uid, history_offset=offset)
+  with _measure("DynSpace"):
+    res = await _get_stub().DynSpace(req)
   next_offset = res.history_offset if res.has_more else None
   return res.list, next_offset
 
@@ -76,19 +142,64 @@ async def json_fetch(uid: int, offset: str = "") -> Tuple[List[Dict[Any, Any]],
 
 
 @overload
-async def grpc_get(id: str) -> "DynamicItem": ...
+async def grpc_get(id: str, *, merge: bool = ...) -> "DynamicItem": ...
 @overload
 async def grpc_get(id: List[str]) -> List["DynamicItem"]: ...
-async def grpc_get(id: Union[str, List[str]]) -> Union["DynamicItem", List["DynamicItem"]]:
-  async with grpc.aio.secure_channel(GRPC_API, grpc.ssl_channel_credentials()) as channel:
-    stub = cast("DynamicAsyncStub", DynamicStub(channel))
-    if isinstance(id, list):
-      req = DynDetailsReq(dynamic_ids=",".join(id))
-      res = await stub.DynDetails(req, metadata=GRPC_METADATA)
-      return list(res.list)
-    req2 = DynDetailReq(dynamic_id=id)
-    res2 = await stub.DynDetail(req2, metadata=GRPC_METADATA)
-    return res2.item
+async def grpc_get(
+  id: Union[str, List[str]], *, merge: bool = False,
+) -> Union["DynamicItem", List["DynamicItem"]]:
+  global _detail_task
+  if isinstance(id, list):
+    return await _grpc_get_many(id)
+  if not merge:
+    return await _grpc_get_one(id)
+  # 同一轮事件循环中获取单条动态的请求合并成一次 DynDetails
+  # 找不到动态时会抛出 LookupError，而不是 DynDetail 返回的错误
+  future: "asyncio.Future[DynamicItem]" = asyncio.get_running_loop().create_future()
+  if not _detail_waiters:
+    _detail_task = asyncio.create_task(_flush_details())
+  _detail_waiters.setdefault(id, []).append(future)
+  return await future
+
+
+async def _grpc_get_one(id: str) -> "DynamicItem":
+  req = DynDetailReq(dynamic_id=id)
+  with _measure("DynDetail"):
+    res = await _get_stub().DynDetail(req, metadata=GRPC_METADATA)
+  return res.item
+
+
+async def _grpc_get_many(ids: List[str]) -> List["DynamicItem"]:
+  req = DynDetailsReq(dynamic_ids=",".join(ids))
+  with _measure("DynDetails"):
+    res = await _get_stub().DynDetails(req, metadata=GRPC_METADATA)
+  return list(res.list)
+
+
+async def _flush_details() -> None:
+  waiters = dict(_detail_waiters)
+  _detail_waiters.clear()
+  ids = list(waiters)
+  try:
+    if len(ids) == 1:
+      # 只有一条时还用 DynDetail，和以前的行为一致
+      items = {ids[0]: await _grpc_get_one(ids[0])}
+    else:
+      items = {item.extend.dyn_id_str: item for item in await _grpc_get_many(ids)}
+  except Exception as e:
+    for futures in waiters.values():
+      for future in futures:
+        if not future.done():
+          future.set_exception(e)
+    return
+  for id, futures in waiters.items():
+    for future in futures:
+      if future.done():
+        continue
+      if id in items:
+        future.set_result(items[id])
+      else:
+        future.set_exception(LookupError(f"找不到动态 {id}"))
 
 
 async def json_get(id: str, cookie: str = "") -> Dict[Any, Any]:
@@ -1,23 +1,33 @@
 import asyncio
+from collections import OrderedDict
 from io import BytesIO
 from typing import Dict, Optional
 
 from PIL import Image
 
-from util import imutil, misc, textutil
+from util import imutil, misc, textutil, user_aliases
 from util.images.card import CONTENT_WIDTH, PADDING, WIDTH, Render
 
 from . import RichText, RichTextEmotion, RichTextText, Topic
 
 EMOTION_SIZE = 48
+EMOTION_CACHE_SIZE = 256
+_emotions: "OrderedDict[str, Image.Image]" = OrderedDict()
 
 
 async def fetch_emotion(url: str) -> Image.Image:
-  async with misc.http().get(url) as response:
-    data = await response.read()
-  return await misc.to_thread(lambda:
+  # 表情数量不多而且经常重复，缓存缩放好的图片，返回副本防止调用者修改缓存
+  if (emotion := _emotions.get(url, None)) is not None:
+    _emotions.move_to_end(url)
+    return emotion.copy()
+  data = await user_aliases.download_image_data(url)
+  emotion = await misc.to_thread(lambda:
     Image.open(BytesIO(data)).resize((EMOTION_SIZE, EMOTION_SIZE), imutil.scale_resample()),
   )
+  _emotions[url] = emotion
+  while len(_emotions) > EMOTION_CACHE_SIZE:
+    _emotions.popitem(False)
+  return emotion.copy()
 
 
 async def fetch_emotions(richtext: RichText) -> Dict[str, Image.Image]:
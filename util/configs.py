@@ -1,11 +1,15 @@
 # 当我写下这段时，只有上帝和我明白我在做什么
 # 现在只有上帝明白了
+import asyncio
+import json
 import os
 import shutil
+import sqlite3
 from dataclasses import dataclass
 from threading import Lock
 from typing import (
-  Any, Callable, ClassVar, Dict, Generic, Iterable, List, Literal, Optional, Tuple, Type, TypeVar,
+  Any, Callable, ClassVar, Dict, Generic, Iterable, List, Literal, Optional, Set, Tuple, Type,
+  TypeVar,
 )
 
 import yaml
@@ -38,6 +42,102 @@ LoadHandler = Callable[[Optional[TModel], TModel, Unpack[TParam]], None]
 Reloadable = Literal[False, "eager", "lazy"]
 
 
+class Storage:
+  def read(self, file: str) -> Optional[Any]:
+    raise NotImplementedError
+
+  def write(self, file: str, data: Any) -> None:
+    raise NotImplementedError
+
+
+def _atomic_write(file: str, text: str) -> None:
+  os.makedirs(os.path.dirname(file), exist_ok=True)
+  # 先写临时文件再替换，中途退出也不会留下写了一半的文件
+  with open(file + ".tmp", "w") as f:
+    f.write(text)
+  os.replace(file + ".tmp", file)
+
+
+class YamlStorage(Storage):
+  def read(self, file: str) -> Optional[Any]:
+    if not os.path.exists(file):
+      return None
+    with open(file) as f:
+      return yaml.load(f, SafeLoader)
+
+  def write(self, file: str, data: Any) -> None:
+    _atomic_write(file, yaml.dump(data, None, SafeDumper, allow_unicode=True))
+
+
+class JsonStorage(Storage):
+  # 和 YAML 一样一个文件一个状态，但解析和序列化快得多
+  def read(self, file: str) -> Optional[Any]:
+    file = os.path.splitext(file)[0] + ".json"
+    if not os.path.exists(file):
+      return None
+    with open(file) as f:
+      return json.load(f)
+
+  def write(self, file: str, data: Any) -> None:
+    file = os.path.splitext(file)[0] + ".json"
+    _atomic_write(file, json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+
+
+class SqliteStorage(Storage):
+  # 所有状态存在一个数据库里，每个文件对应一行，修改一个群的状态只更新一行
+  def __init__(self, path: str) -> None:
+    self.path = path
+    self.connection: Optional[sqlite3.Connection] = None
+    self.lock = Lock()
+
+  def connect(self) -> sqlite3.Connection:
+    if self.connection is None:
+      os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+      connection.execute("PRAGMA journal_mode=WAL")
+      connection.execute(
+        "CREATE TABLE IF NOT EXISTS states (key TEXT PRIMARY KEY, data TEXT NOT NULL)",
+      )
+      self.connection = connection
+    return self.connection
+
+  def read(self, file: str) -> Optional[Any]:
+    with self.lock:
+      row = self.connect().execute(
+        "SELECT data FROM states WHERE key = ?", (os.path.splitext(file)[0],),
+      ).fetchone()
+    return None if row is None else json.loads(row[0])
+
+  def write(self, file: str, data: Any) -> None:
+    text = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    with self.lock:
+      self.connect().execute(
+        "INSERT INTO states (key, data) VALUES (?, ?) "
+        "ON CONFLICT (key) DO UPDATE SET data = excluded.data",
+        (os.path.splitext(file)[0], text),
+      )
+
+
+StorageName = Literal["yaml", "json", "sqlite"]
+YAML_STORAGE = YamlStorage()
+STORAGES: Dict[StorageName, Storage] = {
+  "yaml": YAML_STORAGE,
+  "json": JsonStorage(),
+  "sqlite": SqliteStorage("states/states.db"),
+}
+
+
+Stamp = Tuple[int, int]
+
+
+def _stamp(file: str) -> Optional[Stamp]:
+  try:
+    stat = os.stat(file)
+  except FileNotFoundError:
+    return None
+  return stat.st_mtime_ns, stat.st_size
+
+
 @dataclass
 class CacheItem(Generic[TModel]):
   item: TModel
@@ -47,6 +147,8 @@ class CacheItem(Generic[TModel]):
 class BaseConfig(Generic[TModel, Unpack[TParam]]):
   category: ClassVar = "配置"
   all: ClassVar[List["BaseConfig[Any, Unpack[Tuple[Any, ...]]]"]] = []
+  write_delay: ClassVar[float] = 0  # 秒，大于 0 时 dump 只标记，延迟合并后在线程里写入
+  use_state_storage: ClassVar[bool] = False  # 为 True 时使用 misc 配置中的 state_storage
 
   def __init__(self, model: Type[TModel], reloadable: Reloadable = "lazy") -> None:
     self.model = model
@@ -54,6 +156,12 @@ class BaseConfig(Generic[TModel, Unpack[TParam]]):
     self.reloadable: Reloadable = reloadable
     self.handlers: List[LoadHandler[TModel, Unpack[TParam]]] = []
     self.lock = Lock()
+    self.dirty: Set[Tuple[Unpack[TParam]]] = set()
+    self.write_handle: Optional[asyncio.TimerHandle] = None
+    self.write_lock = Lock()
+    self.write_seq = 0
+    self.written_seq: Dict[Tuple[Unpack[TParam]], int] = {}
+    self.stamps: Dict[Tuple[Unpack[TParam]], Optional[Stamp]] = {}
     self.all.append(self)
 
   def get_file(self, *args: Unpack[TParam]) -> str:
@@ -66,15 +174,34 @@ class BaseConfig(Generic[TModel, Unpack[TParam]]):
           self.load(*args)
     return self.cache[args].item
 
+  @property
+  def storage(self) -> Storage:
+    # 每次读写时才查询，不依赖 misc 配置的加载顺序
+    if not self.use_state_storage:
+      return YAML_STORAGE
+    from . import misc
+    return STORAGES[misc.CONFIG().state_storage]
+
   def load(self, *args: Unpack[TParam]) -> None:
+    if args in self.dirty:  # 先写入还没保存的修改
+      self.dirty.discard(args)
+      self.write(args, *self.snapshot(args))
+    self.apply(args, self.read(*args))
+
+  def read(self, *args: Unpack[TParam]) -> TModel:
+    # 只读取和验证，不修改缓存，可以在别的线程运行
     file = self.get_file(*args)
-    if os.path.exists(file):
+    self.stamps[args] = _stamp(file)  # 在读取之前，读取时的修改下次还能发现
+    data = self.storage.read(file)
+    if data is None and self.storage is not YAML_STORAGE:
+      data = YAML_STORAGE.read(file)  # 还没有迁移的旧文件
+    if data is not None:
       logger.info(f"加载{self.category}文件: {file}")
-      with open(file) as f:
-        new_config = self.model.model_validate(yaml.load(f, SafeLoader))
-    else:
-      logger.info(f"{self.category}文件不存在: {file}")
-      new_config = self.model()
+      return self.model.model_validate(data)
+    logger.info(f"{self.category}文件不存在: {file}")
+    return self.model()
+
+  def apply(self, args: Tuple[Unpack[TParam]], new_config: TModel) -> None:
     if args not in self.cache:
       old_config = None
       self.cache[args] = CacheItem(new_config)
@@ -86,14 +213,66 @@ class BaseConfig(Generic[TModel, Unpack[TParam]]):
     for handler in self.handlers:
       handler(old_config, new_config, *args)
 
+  def changed(self) -> List[Tuple[Unpack[TParam]]]:
+    # 被外部修改过的文件（自己写入时会更新 stamps）
+    if self.storage is not YAML_STORAGE:
+      return []
+    with self.write_lock:  # 正在写入时文件和 stamps 可能不一致
+      return [
+        args for args in list(self.cache)
+        if args in self.stamps and _stamp(self.get_file(*args)) != self.stamps[args]
+      ]
+
+  def snapshot(self, args: Tuple[Unpack[TParam]]) -> Tuple[int, Any]:
+    # 必须在修改数据的线程里复制，写入可以在别的线程
+    self.write_seq += 1
+    return self.write_seq, encode(self.cache[args].item.model_dump())
+
+  def write(self, args: Tuple[Unpack[TParam]], seq: int, data: Any) -> None:
+    file = self.get_file(*args)
+    with self.write_lock:
+      if self.written_seq.get(args, 0) > seq:  # 已经写入了更新的数据
+        return
+      self.written_seq[args] = seq
+      self.storage.write(file, data)
+      self.stamps[args] = _stamp(file)
+
   def dump(self, *args: Unpack[TParam]) -> None:
     if args not in self.cache:
       return
-    data = encode(self.cache[args].item.model_dump())
-    file = self.get_file(*args)
-    os.makedirs(os.path.dirname(file), exist_ok=True)
-    with open(file, "w") as f:
-      yaml.dump(data, f, SafeDumper, allow_unicode=True)
+    try:
+      loop = asyncio.get_running_loop()
+    except RuntimeError:
+      loop = None
+    if self.write_delay <= 0 or loop is None:
+      self.dirty.discard(args)
+      self.write(args, *self.snapshot(args))
+      return
+    self.dirty.add(args)
+    if self.write_handle is None:
+      self.write_handle = loop.call_later(self.write_delay, self._write_dirty)
+
+  def _write_dirty(self) -> None:
+    self.write_handle = None
+    pending = [(args, *self.snapshot(args)) for args in self.dirty if args in self.cache]
+    self.dirty.clear()
+
+    def write_all() -> None:
+      for args, seq, data in pending:
+        try:
+          self.write(args, seq, data)
+        except Exception:
+          logger.exception(f"写入{self.category}文件失败: {self.get_file(*args)}")
+    asyncio.get_running_loop().run_in_executor(None, write_all)
+
+  def flush(self) -> None:
+    if self.write_handle is not None:
+      self.write_handle.cancel()
+      self.write_handle = None
+    pending = [(args, *self.snapshot(args)) for args in self.dirty if args in self.cache]
+    self.dirty.clear()
+    for args, seq, data in pending:
+      self.write(args, seq, data)
 
   def onload(
     self,
@@ -108,6 +287,26 @@ class BaseConfig(Generic[TModel, Unpack[TParam]]):
   def get_all(self) -> Iterable[Tuple[Unpack[TParam]]]:
     raise NotImplementedError
 
+  def get_existing(self) -> Iterable[Tuple[Unpack[TParam]]]:
+    # 已经有 YAML 文件的参数
+    raise NotImplementedError
+
+  def migrate(self) -> int:
+    # 把 YAML 文件转换到当前的存储，已经加载的以内存中的为准，已经转换过的跳过
+    count = 0
+    self.flush()
+    for args in self.get_existing():
+      file = self.get_file(*args)
+      if args in self.cache:
+        self.write(args, *self.snapshot(args))
+      elif self.storage.read(file) is None and (data := YAML_STORAGE.read(file)) is not None:
+        self.write_seq += 1
+        self.write(args, self.write_seq, encode(self.model.model_validate(data).model_dump()))
+      else:
+        continue
+      count += 1
+    return count
+
   def load_all(self) -> None:
     for i in self.get_all():
       self.load(*i)
@@ -136,10 +335,16 @@ class SharedConfig(BaseConfig[TModel]):
   def get_all(self) -> Iterable[Tuple[()]]:
     yield ()
 
+  def get_existing(self) -> Iterable[Tuple[()]]:
+    if os.path.exists(self.get_file()):
+      yield ()
+
 
 class SharedState(SharedConfig[TModel]):
   category = "状态"
   base_dir = "states"
+  write_delay = 1
+  use_state_storage = True
 
 
 class GroupConfig(BaseConfig[TModel, int]):
@@ -161,7 +366,71 @@ class GroupConfig(BaseConfig[TModel, int]):
     for i in context.CONFIG().groups:
       yield (i,)
 
+  def get_existing(self) -> Iterable[Tuple[int]]:
+    base = f"{self.base_dir}/{self.name}"
+    if not os.path.isdir(base):
+      return
+    for file in os.listdir(base):
+      name, ext = os.path.splitext(file)
+      if ext == ".yaml" and name.lstrip("-").isdecimal():
+        yield (int(name),)
+
 
 class GroupState(GroupConfig[TModel]):
   category = "状态"
   base_dir = "states"
+  write_delay = 1
+  use_state_storage = True
+
+
+def flush_all() -> None:
+  for config in BaseConfig.all:
+    config.flush()
+
+
+def migrate_states() -> int:
+  count = 0
+  for config in BaseConfig.all:
+    if config.category == "状态" and config.storage is not YAML_STORAGE:
+      count += config.migrate()
+  return count
+
+
+async def reload_changed() -> None:
+  loop = asyncio.get_running_loop()
+  for config in BaseConfig.all:
+    if not config.reloadable:
+      continue
+    for args in config.changed():
+      file = config.get_file(*args)
+      if args in config.dirty:
+        logger.warning(f"{config.category}文件被修改，但还有没保存的修改，将会被覆盖: {file}")
+        continue
+      try:
+        # 在线程里读取和验证，验证通过后再在事件循环里替换，不会读到一半的配置
+        new_config = await loop.run_in_executor(None, lambda: config.read(*args))
+      except Exception:
+        logger.exception(f"重载{config.category}文件失败，将继续使用旧的: {file}")
+        continue
+      config.apply(args, new_config)
+
+
+async def watch(interval: float) -> None:
+  try:
+    from watchfiles import awatch
+  except ImportError:
+    logger.info("似乎没有安装watchfiles，将定时检查配置文件是否修改")
+    while True:
+      await asyncio.sleep(interval)
+      try:
+        await reload_changed()
+      except Exception:
+        logger.exception("检查配置文件失败")
+  dirs = {SharedConfig.base_dir, SharedState.base_dir, GroupConfig.base_dir, GroupState.base_dir}
+  for base in dirs:
+    os.makedirs(base, exist_ok=True)
+  async for _ in awatch(*dirs):
+    try:
+      await reload_changed()
+    except Exception:
+      logger.exception("检查配置文件失败")
@@ -1,9 +1,16 @@
 import importlib
+import importlib.util
 import pkgutil
+import time
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Dict, List, Set, Tuple
 
+try:
+  import resource
+except ImportError:  # Windows
+  resource = None
+
 import nonebot
 import yaml
 from loguru import logger
@@ -31,6 +38,13 @@ class Missing:
   groups: List[str]
 
 
+@dataclass
+class Profile:
+  name: str
+  seconds: float
+  memory: int  # 峰值内存增长，单位 KiB
+
+
 CONFIG = configs.SharedConfig("plugins", Config, False)
 ROOT_DIR = Path(__file__).resolve().parents[1]
 MODULES: Dict[str, bool] = {}
@@ -58,12 +72,11 @@ def children(parent: str) -> Tuple[List[str], List[Missing]]:
     missing: List[str] = []
     for module in requirements:
       if module not in MODULES:
+        # 只查找不导入，像 cv2、jieba 这样的依赖导入一次就要好几秒
         try:
-          importlib.import_module(module)
-        except ImportError:
+          MODULES[module] = importlib.util.find_spec(module) is not None
+        except (ImportError, ValueError):
           MODULES[module] = False
-        else:
-          MODULES[module] = True
       if not MODULES[module]:
         missing.append(module)
     if missing:
@@ -96,7 +109,13 @@ def load_children(parent: str) -> None:
   logger.opt(depth=1).success(f"加载了 {count} 个子模块")
 
 
-def load_plugins():
+def _max_rss() -> int:
+  if resource is None:
+    return 0
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def load_plugins(profile: bool = False) -> List[Profile]:
   config = CONFIG()
   availables, missings = children("plugins")
   for i in missings:
@@ -105,5 +124,22 @@ def load_plugins():
       "你可以使用此命令来安装: pdm install"
       + "".join(f" -G {group}" for group in i.groups),
     )
-  nonebot.load_all_plugins((f"plugins.{name}" for name in availables), ())
-  nonebot.load_all_plugins(config.extra_plugins, config.extra_dirs)
+  if not profile:
+    nonebot.load_all_plugins((f"plugins.{name}" for name in availables), ())
+    nonebot.load_all_plugins(config.extra_plugins, config.extra_dirs)
+    return []
+  # 逐个加载并记录耗时和内存，子模块算在父插件里
+  profiles: List[Profile] = []
+  for name in [*(f"plugins.{name}" for name in availables), *config.extra_plugins]:
+    begin_time = time.perf_counter()
+    begin_rss = _max_rss()
+    nonebot.load_plugin(name)
+    profiles.append(Profile(name, time.perf_counter() - begin_time, _max_rss() - begin_rss))
+  if config.extra_dirs:
+    begin_time = time.perf_counter()
+    begin_rss = _max_rss()
+    nonebot.load_all_plugins((), config.extra_dirs)
+    profiles.append(Profile(
+      "、".join(config.extra_dirs), time.perf_counter() - begin_time, _max_rss() - begin_rss,
+    ))
+  return profiles
@@ -1,10 +1,18 @@
+import asyncio
+import json
 import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from typing import (
-  Any, Generator, List, Literal, Optional, Protocol, Sequence, Tuple, Type, TypeVar, Union, cast,
-  overload,
+  Any, Dict, Generator, List, Literal, Optional, Protocol, Sequence, Tuple, Type, TypeVar, Union,
+  cast, overload,
 )
 
+import aiohttp
 import cairo
 from loguru import logger
 from nonebot.adapters.onebot.v11 import MessageSegment
@@ -13,10 +21,11 @@ from PIL import Image, ImageChops, ImageDraw, ImageOps, ImageSequence, features
 from util import colorutil, misc
 
 __all__ = [
-  'Anchor', 'AnyImage', 'Color', 'PasteColor', 'PerspectiveData', 'PixelAccess', 'Plane', 'Point',
-  'RemapTransform', 'Size', 'background', 'center_pad', 'circle', 'colorize', 'contain_down',
-  'frames', 'from_cairo', 'get_avatar', 'load', 'paste', 'quantize', 'resize_canvas',
-  'resize_height', 'resize_width', 'sample_frames', 'to_segment',
+  'Anchor', 'AnyImage', 'AvatarSize', 'Color', 'PasteColor', 'PerspectiveData', 'PixelAccess',
+  'Plane', 'Point', 'RemapTransform', 'Size', 'background', 'center_pad', 'circle', 'colorize',
+  'contain_down', 'frames', 'from_cairo', 'get_avatar', 'get_avatar_data', 'load', 'paste',
+  'quantize', 'quantize_frames', 'resize_canvas', 'resize_height', 'resize_width',
+  'sample_frames', 'to_segment',
 ]
 
 Anchor = Literal["lt", "lm", "lb", "mt", "mm", "mb", "rt", "rm", "rb"]
@@ -27,9 +36,15 @@ Plane = Tuple[Point, Point, Point, Point]
 PerspectiveData = Tuple[float, float, float, float, float, float, float, float]
 PasteColor = Tuple[Color, Size]
 AnyImage = Union[Image.Image, cairo.ImageSurface]
+AvatarSize = Literal[0, 100, 640]  # 0 为原图
 T = TypeVar("T")
+AVATAR_DIR = "states/avatars"
 _LIBIMAGEQUANT_AVAILABLE: Optional[bool] = None
 _LIBIMAGEQUANT_WARNED: bool = False
+_encode_pool: Optional[ThreadPoolExecutor] = None
+_avatar_tasks: Dict[str, "asyncio.Task[bytes]"] = {}
+_avatar_images: "OrderedDict[str, Tuple[bytes, Image.Image]]" = OrderedDict()
+_avatar_lock = threading.Lock()
 
 
 def resample() -> Image.Resampling:
@@ -41,41 +56,39 @@ def scale_resample() -> Image.Resampling:
 
 
 def from_cairo(surface: cairo.ImageSurface) -> Image.Image:
+  # 直接从 surface 的缓冲区解码，不经过 bytes 复制和通道拆分合并
+  # 不能用 frombuffer 共享内存，surface 在 with 语句结束后就会被释放
+  # cairo 按本机字节序存储 32 位像素，这里假定为小端序，即内存中为 BGRA
+  surface.flush()
   w = surface.get_width()
   h = surface.get_height()
   data = surface.get_data()
+  stride = surface.get_stride()
   format = surface.get_format()
   if format == cairo.Format.A1:
     if not data:
       return Image.new("1", (w, h))
-    data_w = math.ceil(w / 32) * 32
-    im = Image.frombytes("1", (data_w, h), bytes(data))
-    for x in range(0, w, 8):
-      im.paste(im.crop((x, 0, x + 8, h)).transpose(Image.Transpose.FLIP_LEFT_RIGHT), (x, 0))
-    return im.crop((0, 0, w, h))
+    return Image.frombytes("1", (w, h), data, "raw", "1;R", stride)  # 低位在前
   elif format == cairo.Format.A8:
     if not data:
       return Image.new("L", (w, h))
-    data_w = math.ceil(w / 4) * 4
-    return Image.frombytes("L", (data_w, h), bytes(data)).crop((0, 0, w, h))
+    return Image.frombytes("L", (w, h), data, "raw", "L", stride)
   elif format == cairo.Format.RGB24:
     if not data:
       return Image.new("RGB", (w, h))
-    b, g, r, _ = Image.frombytes("RGBX", (w, h), bytes(data)).split()
-    return Image.merge("RGB", (r, g, b))
+    return Image.frombytes("RGB", (w, h), data, "raw", "BGRX", stride)
   elif format == cairo.Format.ARGB32:
     if not data:
       return Image.new("RGBA", (w, h))
-    b, g, r, a = Image.frombytes("RGBa", (w, h), bytes(data)).convert("RGBA").split()
-    return Image.merge("RGBA", (r, g, b, a))  # BGRa -> BGRA -> RGBA
+    return Image.frombytes("RGBA", (w, h), data, "raw", "BGRa", stride)  # 预乘 Alpha
   else:
     raise NotImplementedError(f"Unsupported format: {format}")
 
 
 def to_cairo(im: Image.Image) -> cairo.ImageSurface:
-  im = im.convert("RGBA").convert("RGBa")  # 不能由 RGB 直接转换为 RGBa
-  r, g, b, a = im.split()
-  data = memoryview(bytearray(Image.merge("RGBa", (b, g, r, a)).tobytes()))
+  if im.mode != "RGBA":
+    im = im.convert("RGBA")
+  data = memoryview(bytearray(im.tobytes("raw", "BGRa")))
   return cairo.ImageSurface.create_for_data(data, cairo.FORMAT_ARGB32, im.width, im.height)
 
 
@@ -198,27 +211,110 @@ def background(im: AnyImage, bg: Color = (255, 255, 255)) -> Image.Image:
   return im.convert("RGB")
 
 
-async def get_avatar(
-  uid: Optional[int] = None, gid: Optional[int] = None, *, raw: bool = False,
-  bg: Union[Color, bool] = False,
-) -> Image.Image:
-  # s 有 100, 160, 640, 1080 分别对应 4 个最大尺寸（可以小）和 0 对应原图（不能不填或者自定义）
+# 缓存文件的第一行是 JSON 格式的元数据，之后是头像本身，一起读写和淘汰
+def _read_avatar(path: str) -> Tuple[Dict[str, Any], Optional[bytes]]:
+  try:
+    with open(path, "rb") as f:
+      meta = json.loads(f.readline())
+      data = f.read()
+  except (FileNotFoundError, ValueError):
+    return {}, None
+  os.utime(path)  # 按最近使用时间淘汰
+  return meta, data
+
+
+def _write_avatar(path: str, meta: Dict[str, Any], data: bytes) -> None:
+  os.makedirs(AVATAR_DIR, exist_ok=True)
+  with open(path + ".tmp", "wb") as f:
+    f.write(json.dumps(meta).encode() + b"\n")
+    f.write(data)
+  os.replace(path + ".tmp", path)
+  misc.evict_directory(AVATAR_DIR, misc.CONFIG().avatar_cache_size)
+
+
+async def _fetch_avatar(key: str, url: str) -> bytes:
+  # 磁盘缓存在 TTL 内直接使用，过期后带上 ETag 和 Last-Modified 重新验证
+  path = os.path.join(AVATAR_DIR, key)
+  meta, data = await misc.to_thread(_read_avatar, path)
+  if data is not None and time.time() - meta.get("time", 0) < misc.CONFIG().avatar_cache_ttl:
+    return data
+  headers: Dict[str, str] = {}
+  if data is not None:
+    if etag := meta.get("etag", None):
+      headers["If-None-Match"] = etag
+    if last_modified := meta.get("last_modified", None):
+      headers["If-Modified-Since"] = last_modified
+  async with misc.http().get(url, headers=headers) as response:
+    if response.status == 304 and data is not None:
+      meta["time"] = time.time()
+      await misc.to_thread(_write_avatar, path, meta, data)
+      return data
+    if response.status != 200:
+      # 错误页面不能当成头像缓存，有旧数据时继续用旧数据
+      if data is not None:
+        logger.warning(f"获取头像 {key} 失败，使用过期的缓存: HTTP {response.status}")
+        return data
+      response.raise_for_status()
+      raise aiohttp.ClientResponseError(
+        response.request_info, response.history, status=response.status,
+        message=response.reason or "", headers=response.headers,
+      )
+    data = await response.read()
+    meta = {
+      "time": time.time(),
+      "etag": response.headers.get("ETag", None),
+      "last_modified": response.headers.get("Last-Modified", None),
+    }
+  await misc.to_thread(_write_avatar, path, meta, data)
+  return data
+
+
+async def get_avatar_data(
+  uid: Optional[int] = None, gid: Optional[int] = None, *, size: AvatarSize = 0,
+) -> Tuple[str, bytes]:
+  # QQ 头像的 s 有 100, 160, 640, 1080 分别对应 4 个最大尺寸（可以小）
+  # 和 0 对应原图（不能不填或者自定义）
+  # 群头像只有 40, 100, 640 和 0
   if uid is not None and gid is None:
-    url = f"https://q1.qlogo.cn/g?b=qq&nk={uid}&s=0"
+    key = f"u{uid}_{size}"
+    url = f"https://q1.qlogo.cn/g?b=qq&nk={uid}&s={size}"
   elif gid is not None and uid is None:
-    url = f"https://p.qlogo.cn/gh/{gid}/{gid}/0/"
+    key = f"g{gid}_{size}"
+    url = f"https://p.qlogo.cn/gh/{gid}/{gid}/{size}/"
   else:
     raise TypeError("uid 和 gid 只能指定一个")
-  async with misc.http().get(url) as response:
-    data = await response.read()
+  # 合并同一个头像的并发请求
+  if (task := _avatar_tasks.get(key, None)) is None:
+    task = _avatar_tasks[key] = asyncio.create_task(_fetch_avatar(key, url))
+    task.add_done_callback(lambda _: _avatar_tasks.pop(key, None))
+  return key, await asyncio.shield(task)
+
+
+async def get_avatar(
+  uid: Optional[int] = None, gid: Optional[int] = None, *, raw: bool = False,
+  bg: Union[Color, bool] = False, size: AvatarSize = 0,
+) -> Image.Image:
+  key, data = await get_avatar_data(uid, gid, size=size)
+
+  def decode() -> Image.Image:
+    # 已解码的头像按原始数据缓存，数据没变就不用再解码一次
+    with _avatar_lock:
+      if (cached := _avatar_images.get(key, None)) and cached[0] == data:
+        _avatar_images.move_to_end(key)
+        return cached[1]
+    im = Image.open(BytesIO(data)).convert("RGBA")
+    with _avatar_lock:
+      _avatar_images[key] = (data, im)
+      while len(_avatar_images) > misc.CONFIG().avatar_cache_count:
+        _avatar_images.popitem(False)
+    return im
 
   def process() -> Image.Image:
-    raw_avatar = Image.open(BytesIO(data))
     if raw:
-      return raw_avatar
+      return Image.open(BytesIO(data))  # 可能是动图，不能缓存
     if bg is False:
-      return raw_avatar.convert("RGBA")
-    return background(raw_avatar, (255, 255, 255) if bg is True else bg)
+      return decode().copy()
+    return background(decode(), (255, 255, 255) if bg is True else bg)
   return await misc.to_thread(process)
 
 
@@ -390,6 +486,71 @@ def quantize(im: AnyImage, palette: Optional[Image.Image] = None) -> Image.Image
   return im.quantize(method=method, palette=palette)
 
 
+def _encode_executor() -> ThreadPoolExecutor:
+  global _encode_pool
+  if _encode_pool is None:
+    _encode_pool = ThreadPoolExecutor(thread_name_prefix="imutil_encode")
+  return _encode_pool
+
+
+def _global_palette(frames: Sequence[Image.Image], transparent: bool) -> bytes:
+  config = misc.CONFIG()
+  step = math.ceil(len(frames) / max(config.gif_palette_samples, 1))
+  samples = [flatten(x) if x.mode == "RGBA" else x.convert("RGB") for x in frames[::step]]
+  # 把抽样的帧竖着拼起来一起量化，这样调色板能覆盖整个动画的颜色
+  stacked = Image.new("RGB", (max(x.width for x in samples), sum(x.height for x in samples)))
+  y = 0
+  for x in samples:
+    stacked.paste(x, (0, y))
+    y += x.height
+  colors = 255 if transparent else 256
+  if config.libimagequant is True and _check_libimagequant():
+    p = stacked.convert("RGBA").quantize(colors, method=Image.Quantize.LIBIMAGEQUANT)
+  else:
+    p = stacked.quantize(colors, method=Image.Quantize[config.quantize.upper()])
+  return bytes(cast(List[int], p.getpalette("RGB")))
+
+
+def _apply_palette(
+  im: Image.Image, palette: Image.Image, palette_data: bytes, transparent: bool,
+) -> Image.Image:
+  rgb = flatten(im) if im.mode == "RGBA" else im.convert("RGB")
+  dither = Image.Dither.FLOYDSTEINBERG if misc.CONFIG().dither else Image.Dither.NONE
+  p = rgb.quantize(palette=palette, dither=dither)
+  if not transparent:
+    return p
+  # 透明色放在调色板最后，和 quantize 一样
+  pos = len(palette_data) // 3
+  p.putpalette(palette_data + b"\0\0\0")
+  p.info["transparency"] = pos
+  if im.mode == "RGBA":
+    p.paste(pos, mask=ImageChops.invert(im.getchannel("A").convert("1")))
+  return p
+
+
+def quantize_frames(frames: Sequence[AnyImage]) -> List[Image.Image]:
+  images = [from_cairo(x) if isinstance(x, cairo.ImageSurface) else x for x in frames]
+  # 已经是调色板模式的帧保持原样
+  todo = [x for x in images if x.mode != "P"]
+  if not todo:
+    return images
+  executor = _encode_executor()
+  if misc.CONFIG().gif_palette == "frame":
+    return list(executor.map(lambda x: x if x.mode == "P" else quantize(x), images))
+  # 所有帧共用一个调色板，GIF 只需要写一个全局颜色表
+  # 相同的颜色也会映射到相同的下标，Pillow 按帧差裁剪时能裁掉更多
+  transparent = any(
+    x.mode == "RGBA" and x.getchannel("A").getextrema()[0] < 255 for x in todo
+  )
+  palette_data = _global_palette(todo, transparent)
+  palette = Image.new("P", (1, 1))
+  palette.putpalette(palette_data)
+  return list(executor.map(
+    lambda x: x if x.mode == "P" else _apply_palette(x, palette, palette_data, transparent),
+    images,
+  ))
+
+
 @overload
 def to_segment(im: AnyImage, *, fmt: str = ..., **kw: Any) -> MessageSegment: ...
 
@@ -416,12 +577,19 @@ def to_segment(
         duration = [im.info["duration"] for im in ImageSequence.Iterator(duration)]
       if isinstance(duration, list) and len(duration) != len(im):
         raise ValueError("Duration list length doesn't match frames count.")
-      if afmt.lower() == "gif":
-        frames = [x if x.mode == "P" else quantize(x) for x in frames]
+      afmt = afmt.lower()
+      if afmt == "gif":
+        frames = quantize_frames(frames)
         # 只对透明图片使用 disposal，防止不透明图片有鬼影
         disposal = 2 if any("transparency" in x.info for x in frames) else 0
         frames[0].save(
-          f, "GIF", append_images=im[1:], save_all=True, loop=0, disposal=disposal,
+          f, "GIF", append_images=frames[1:], save_all=True, loop=0, disposal=disposal,
+          duration=duration, **kw,
+        )
+      else:
+        # WebP 和 APNG 支持真彩色和半透明，不需要量化
+        frames[0].save(
+          f, "PNG" if afmt == "apng" else afmt, append_images=frames[1:], save_all=True, loop=0,
           duration=duration, **kw,
         )
       return MessageSegment.image(f)
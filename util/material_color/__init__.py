@@ -1,6 +1,9 @@
 # 修改自 https://github.com/avanisubbiah/material-color-utilities-python
 # 移除了不必要的 import，增加类型注解
 # pyright: strict
+import hashlib
+from collections import OrderedDict
+from threading import Lock
 from typing import List, Tuple
 
 from PIL import Image
@@ -10,6 +13,40 @@ from . import score
 from .color_utils import argb_from_rgb
 from .quantize import quantizer_celebi
 
+try:
+  import numpy as np
+
+  from .quantize import quantizer_numpy
+except ImportError:
+  _NUMPY_AVAILABLE = False
+else:
+  _NUMPY_AVAILABLE = True
+
+_MAX_PIXELS = 128 * 128
+_CACHE_SIZE = 256
+_cache: "OrderedDict[bytes, int]" = OrderedDict()
+_cache_lock = Lock()
+
+
+def _source_color(image: Image.Image) -> int:
+  if _NUMPY_AVAILABLE:
+    # 和下面的循环顺序一致（先列后行），保证结果相同
+    data = np.asarray(image).transpose(1, 0, 2).reshape(-1, 4)
+    result = quantizer_numpy.quantize(data[data[:, 3] == 255, :3], 128)
+  else:
+    px = imutil.load(image, Tuple[int, int, int, int])
+    pixels: List[int] = []
+    for x in range(image.width):
+      for y in range(image.height):
+        r, g, b, a = px[x, y]
+        if a < 255:
+          continue
+        argb = argb_from_rgb(r, g, b)
+        pixels.append(argb)
+    result = quantizer_celebi.quantize(pixels, 128)
+  ranked = score.score(result)
+  return ranked[0]
+
 
 def source_color_from_image(image: Image.Image) -> int:
   '''
@@ -18,16 +55,18 @@ def source_color_from_image(image: Image.Image) -> int:
   :return: Source color - the color most suitable for creating a UI theme
   '''
   image = image.convert("RGBA")
-  px = imutil.load(image, Tuple[int, int, int, int])
-  pixels: List[int] = []
-  for x in range(image.width):
-    for y in range(image.height):
-      r, g, b, a = px[x, y]
-      if a < 255:
-        continue
-      argb = argb_from_rgb(r, g, b)
-      pixels.append(argb)
-
-  result = quantizer_celebi.quantize(pixels, 128)
-  ranked = score.score(result)
-  return ranked[0]
+  if image.width * image.height > _MAX_PIXELS:
+    # 用最近邻缩小，相当于均匀抽样，不会混合出新的颜色
+    image.thumbnail((128, 128), Image.Resampling.NEAREST)
+  key = hashlib.blake2b(image.tobytes(), digest_size=16).digest()
+  key += image.width.to_bytes(4, "little")
+  with _cache_lock:
+    if (color := _cache.get(key)) is not None:
+      _cache.move_to_end(key)
+      return color
+  color = _source_color(image)
+  with _cache_lock:
+    _cache[key] = color
+    while len(_cache) > _CACHE_SIZE:
+      _cache.popitem(False)
+  return color
@@ -116,6 +116,14 @@ def _to_argb(hue: float, chroma: float, tone: float, viewing_conditions: Viewing
   return answer.to_argb(viewing_conditions)
 
 
+def argb_from_hct(hue: float, chroma: float, tone: float) -> int:
+  '''
+  Same as int(Hct(hue, chroma, tone)), but solves only once.
+  :return: ARGB representation of a color in default viewing conditions
+  '''
+  return _to_argb(hue, chroma, tone)
+
+
 class Hct:
   '''
   HCT, hue, chroma, and tone. A color system that provides a perceptually accurate color
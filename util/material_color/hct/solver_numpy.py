@@ -0,0 +1,210 @@
+# pyright: strict
+# ruff: noqa: E501
+from typing import Any, Tuple
+
+import numpy as np
+
+from ..color_utils import _XYZ_TO_SRGB  # pyright: ignore[reportPrivateUsage]
+from ..color_utils import WHITE_POINT_D65, linearized
+from .viewing_conditions import ViewingConditions
+
+'''
+NumPy version of the HCT solver in hct/__init__.py, converting many HCT colors to ARGB at once.
+Every step mirrors the scalar code (Cam16.from_jch, Cam16.to_argb, Cam16.from_argb and the two
+binary searches), so results are the same except for floating point rounding.
+'''
+
+Array = np.ndarray[Any, Any]
+
+_CHROMA_SEARCH_ENDPOINT = 0.4
+_DE_MAX = 1.0
+_DL_MAX = 0.2
+_LIGHTNESS_SEARCH_ENDPOINT = 0.01
+_LINEARIZED = np.array([linearized(i) for i in range(256)])
+_VC = ViewingConditions.DEFAULT
+
+
+def _delinearized(component: Array) -> Array:
+  normalized = component / 100.0
+  delinearized = np.where(
+    normalized <= 0.0031308,
+    normalized * 12.92,
+    1.055 * np.power(np.maximum(normalized, 0.0), 1.0 / 2.4) - 0.055,
+  )
+  return np.clip(np.rint(delinearized * 255.0), 0, 255).astype(np.int64)
+
+
+def _argb_from_xyz(x: Array, y: Array, z: Array) -> Array:
+  matrix = _XYZ_TO_SRGB
+  r = _delinearized(matrix[0][0] * x + matrix[0][1] * y + matrix[0][2] * z)
+  g = _delinearized(matrix[1][0] * x + matrix[1][1] * y + matrix[1][2] * z)
+  b = _delinearized(matrix[2][0] * x + matrix[2][1] * y + matrix[2][2] * z)
+  return (255 << 24) | (r << 16) | (g << 8) | b
+
+
+def _argb_from_lstar(lstar: Array) -> Array:
+  fy = (lstar + 16.0) / 116.0
+  kappa = 24389.0 / 27.0
+  epsilon = 216.0 / 24389.0
+  y = np.where(lstar > 8.0, fy * fy * fy, lstar / kappa)
+  xz = np.where(fy * fy * fy > epsilon, fy * fy * fy, lstar / kappa)
+  return _argb_from_xyz(xz * WHITE_POINT_D65[0], y * WHITE_POINT_D65[1], xz * WHITE_POINT_D65[2])
+
+
+def _linear_rgb(argb: Array) -> Tuple[Array, Array, Array]:
+  return _LINEARIZED[(argb >> 16) & 255], _LINEARIZED[(argb >> 8) & 255], _LINEARIZED[argb & 255]
+
+
+def _lstar_from_argb(argb: Array) -> Array:
+  r, g, b = _linear_rgb(argb)
+  y = (0.2126 * r + 0.7152 * g + 0.0722 * b) / 100.0
+  return np.where(y <= 216.0 / 24389.0, 24389.0 / 27.0 * y, 116.0 * np.cbrt(y) - 16.0)
+
+
+def _ucs(j: Array, c: Array, h: Array) -> Tuple[Array, Array, Array]:
+  '''jstar, astar and bstar, as computed by Cam16.from_jch.'''
+  m = c * _VC.fLRoot
+  hueRadians = (h * np.pi) / 180.0
+  jstar = ((1.0 + 100.0 * 0.007) * j) / (1.0 + 0.007 * j)
+  mstar = (1.0 / 0.0228) * np.log(1.0 + 0.0228 * m)
+  return jstar, mstar * np.cos(hueRadians), mstar * np.sin(hueRadians)
+
+
+def _argb_from_jch(j: Array, c: Array, h: Array) -> Array:
+  '''Same as Cam16.from_jch(j, c, h).to_argb().'''
+  vc = _VC
+  alpha = np.where((c == 0.0) | (j == 0.0), 0.0, c / np.sqrt(j / 100.0))
+  t = (alpha / (1.64 - 0.29 ** vc.n) ** 0.73) ** (1.0 / 0.9)
+  hRad = (h * np.pi) / 180.0
+  eHue = 0.25 * (np.cos(hRad + 2.0) + 3.8)
+  ac = vc.aw * np.power(j / 100.0, 1.0 / vc.c / vc.z)
+  p1 = eHue * (50000.0 / 13.0) * vc.nc * vc.ncb
+  p2 = ac / vc.nbb
+  hSin = np.sin(hRad)
+  hCos = np.cos(hRad)
+  gamma = (23.0 * (p2 + 0.305) * t) / (23.0 * p1 + 11.0 * t * hCos + 108.0 * t * hSin)
+  a = gamma * hCos
+  b = gamma * hSin
+  rA = (460.0 * p2 + 451.0 * a + 288.0 * b) / 1403.0
+  gA = (460.0 * p2 - 891.0 * a - 261.0 * b) / 1403.0
+  bA = (460.0 * p2 - 220.0 * a - 6300.0 * b) / 1403.0
+
+  def component(x: Array, d: float) -> Array:
+    base = np.maximum(0, (27.13 * np.abs(x)) / (400.0 - np.abs(x)))
+    return np.sign(x) * (100.0 / vc.fl) * np.power(base, 1.0 / 0.42) / d
+
+  rF = component(rA, vc.rgbD[0])
+  gF = component(gA, vc.rgbD[1])
+  bF = component(bA, vc.rgbD[2])
+  x = 1.86206786 * rF - 1.01125463 * gF + 0.14918677 * bF
+  y = 0.38752654 * rF + 0.62144744 * gF - 0.00897398 * bF
+  z = -0.01584150 * rF - 0.03412294 * gF + 1.04996444 * bF
+  return _argb_from_xyz(x, y, z)
+
+
+def _cam_from_argb(argb: Array) -> Tuple[Array, Array, Array, Array, Array, Array]:
+  '''hue, chroma, j, jstar, astar and bstar, as computed by Cam16.from_argb.'''
+  vc = _VC
+  redL, greenL, blueL = _linear_rgb(argb)
+  x = 0.41233895 * redL + 0.35762064 * greenL + 0.18051042 * blueL
+  y = 0.2126 * redL + 0.7152 * greenL + 0.0722 * blueL
+  z = 0.01932141 * redL + 0.11916382 * greenL + 0.95034478 * blueL
+  rC = 0.401288 * x + 0.650173 * y - 0.051461 * z
+  gC = -0.250268 * x + 1.204414 * y + 0.045854 * z
+  bC = -0.002079 * x + 0.048952 * y + 0.953127 * z
+
+  def component(c: Array, d: float) -> Array:
+    cD = d * c
+    af = np.power((vc.fl * np.abs(cD)) / 100.0, 0.42)
+    return (np.sign(cD) * 400.0 * af) / (af + 27.13)
+
+  rA = component(rC, vc.rgbD[0])
+  gA = component(gC, vc.rgbD[1])
+  bA = component(bC, vc.rgbD[2])
+  a = (11.0 * rA + -12.0 * gA + bA) / 11.0
+  b = (rA + gA - 2.0 * bA) / 9.0
+  u = (20.0 * rA + 20.0 * gA + 21.0 * bA) / 20.0
+  p2 = (40.0 * rA + 20.0 * gA + bA) / 20.0
+  atanDegrees = (np.arctan2(b, a) * 180.0) / np.pi
+  hue = np.where(atanDegrees < 0, atanDegrees + 360.0, np.where(atanDegrees >= 360, atanDegrees - 360.0, atanDegrees))
+  ac = p2 * vc.nbb
+  j = 100.0 * np.power(ac / vc.aw, vc.c * vc.z)
+  huePrime = np.where(hue < 20.14, hue + 360, hue)
+  eHue = 0.25 * (np.cos((huePrime * np.pi) / 180.0 + 2.0) + 3.8)
+  p1 = (50000.0 / 13.0) * eHue * vc.nc * vc.ncb
+  t = (p1 * np.sqrt(a * a + b * b)) / (u + 0.305)
+  alpha = np.power(t, 0.9) * (1.64 - pow(0.29, vc.n)) ** 0.73
+  c = alpha * np.sqrt(j / 100.0)
+  jstar, astar, bstar = _ucs(j, c, hue)
+  return hue, c, j, jstar, astar, bstar
+
+
+def _find_cam_by_j(hue: Array, chroma: Array, tone: Array) -> Tuple[Array, Array]:
+  '''
+  Vectorized hct._find_cam_by_j.
+  :return: Whether a CAM16 color was found, and its ARGB representation (Cam16.to_argb).
+  '''
+  low = np.zeros_like(tone)
+  high = np.full_like(tone, 100.0)
+  bestdL = np.full_like(tone, 1000.0)
+  bestdE = np.full_like(tone, 1000.0)
+  bestHue = np.zeros_like(tone)
+  bestChroma = np.zeros_like(tone)
+  bestJ = np.zeros_like(tone)
+  found = np.zeros(tone.shape, bool)
+  done = np.zeros(tone.shape, bool)
+  while (active := ~done & (np.abs(low - high) > _LIGHTNESS_SEARCH_ENDPOINT)).any():
+    mid = low + (high - low) / 2
+    clipped = _argb_from_jch(mid, chroma, hue)
+    clippedLstar = _lstar_from_argb(clipped)
+    dL = np.abs(tone - clippedLstar)
+    camHue, camChroma, camJ, jstar, astar, bstar = _cam_from_argb(clipped)
+    otherJstar, otherAstar, otherBstar = _ucs(camJ, camChroma, hue)
+    dEPrime = np.sqrt((jstar - otherJstar) ** 2 + (astar - otherAstar) ** 2 + (bstar - otherBstar) ** 2)
+    dE = 1.41 * np.power(dEPrime, 0.63)
+    better = active & (dL < _DL_MAX) & (dE <= _DE_MAX) & (dE <= bestdE)
+    bestdL = np.where(better, dL, bestdL)
+    bestdE = np.where(better, dE, bestdE)
+    bestHue = np.where(better, camHue, bestHue)
+    bestChroma = np.where(better, camChroma, bestChroma)
+    bestJ = np.where(better, camJ, bestJ)
+    found |= better
+    # 对应原版的 break
+    done |= active & (bestdL == 0) & (bestdE == 0)
+    active &= ~done
+    low = np.where(active & (clippedLstar < tone), mid, low)
+    high = np.where(active & (clippedLstar >= tone), mid, high)
+  return found, _argb_from_jch(bestJ, bestChroma, bestHue)
+
+
+def argb_from_hct(hue: Array, chroma: Array, tone: Array) -> Array:
+  '''
+  Vectorized version of Hct(hue, chroma, tone) followed by int().
+  :param hue: Hues in degrees.
+  :param chroma: Chromas, must have the same shape as hue.
+  :param tone: Tones, must have the same shape as hue.
+  :return: ARGB representations, dtype int64.
+  '''
+  with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+    hue = np.mod(np.asarray(hue, np.float64), 360.0)
+    chroma = np.asarray(chroma, np.float64)
+    tone = np.clip(np.asarray(tone, np.float64), 0.0, 100.0)
+    gray = _argb_from_lstar(tone)
+    done = (chroma < 1.0) | (np.rint(tone) <= 0.0) | (np.rint(tone) >= 100.0)
+    result = gray.copy()
+    # 第一次使用原本的色度，找不到时再二分查找最大的色度
+    todo = ~done
+    found, argb = _find_cam_by_j(hue[todo], chroma[todo], tone[todo])
+    result[np.flatnonzero(todo)[found]] = argb[found]
+    done[np.flatnonzero(todo)[found]] = True
+    low = np.zeros_like(chroma)
+    high = chroma.copy()
+    mid = low + (high - low) / 2.0
+    while (active := ~done & (np.abs(low - high) >= _CHROMA_SEARCH_ENDPOINT)).any():
+      index = np.flatnonzero(active)
+      found, argb = _find_cam_by_j(hue[index], mid[index], tone[index])
+      result[index[found]] = argb[found]
+      low[index[found]] = mid[index[found]]
+      high[index[~found]] = mid[index[~found]]
+      mid[index] = low[index] + (high[index] - low[index]) / 2.0
+    return result
@@ -0,0 +1,63 @@
+# pyright: strict
+from functools import lru_cache
+from threading import Lock
+from typing import Dict, List
+
+from .hct import argb_from_hct
+
+try:
+  import numpy as np
+
+  from .hct import solver_numpy
+except ImportError:
+  _NUMPY_AVAILABLE = False
+else:
+  _NUMPY_AVAILABLE = True
+_BATCH_MIN = 50
+
+'''
+A convenience class for retrieving colors that are constant in hue and chroma, but vary in tone.
+'''
+
+
+class TonalPalette:
+  def __init__(self, hue: float, chroma: float) -> None:
+    self.hue = hue
+    self.chroma = chroma
+    self._cache: Dict[int, int] = {}
+    self._lock = Lock()
+
+  def tone(self, tone: int) -> int:
+    '''
+    :param tone: HCT tone, measured from 0 to 100.
+    :return: ARGB representation of a color with that tone.
+    '''
+    with self._lock:
+      if tone not in self._cache:
+        self._cache[tone] = argb_from_hct(self.hue, self.chroma, tone)
+      return self._cache[tone]
+
+  def tones(self) -> List[int]:
+    '''
+    :return: ARGB representations of tone 0 to 100.
+    '''
+    with self._lock:
+      missing = [i for i in range(101) if i not in self._cache]
+      # NumPy 每次调用的固定开销较大，只有一次计算很多色调时才比逐个计算快
+      if _NUMPY_AVAILABLE and len(missing) > _BATCH_MIN:
+        self._cache.update(zip(missing, self._solve(missing)))
+    return [self.tone(i) for i in range(101)]
+
+  def _solve(self, tones: List[int]) -> List[int]:
+    tones_ = np.array(tones, dtype=np.float64)
+    hues = np.full_like(tones_, self.hue)
+    chromas = np.full_like(tones_, self.chroma)
+    return solver_numpy.argb_from_hct(hues, chromas, tones_).tolist()
+
+
+@lru_cache(256)
+def tonal_palette(hue: float, chroma: float) -> TonalPalette:
+  '''
+  :return: A TonalPalette shared by all callers with the same hue and chroma.
+  '''
+  return TonalPalette(hue, chroma)
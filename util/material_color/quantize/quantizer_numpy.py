@@ -0,0 +1,149 @@
+# pyright: strict
+# ruff: noqa: E501
+import math
+import random
+from typing import Any, List, OrderedDict, Tuple
+
+import numpy as np
+
+from ..color_utils import _SRGB_TO_XYZ  # pyright: ignore[reportPrivateUsage]
+from ..color_utils import WHITE_POINT_D65, argb_from_lab, lab_from_argb, linearized
+from . import quantizer_wsmeans, quantizer_wu
+
+'''
+NumPy versions of quantizer_wu's histogram and quantizer_wsmeans' assignment step, operating on
+arrays of pixels instead of lists of ARGB integers. Results are the same as quantizer_celebi for
+the same pixels in the same order, except for floating point rounding.
+'''
+
+Array = np.ndarray[Any, Any]
+
+_LINEARIZED = np.array([linearized(i) for i in range(256)])
+
+
+def _dedupe(pixels: Array) -> Tuple[Array, Array]:
+  '''
+  :param pixels: Opaque pixels, shape (N, 3), dtype uint8.
+  :return: Unique colors in order of first appearance (same as quantizer_map), and their counts.
+  '''
+  packed = (pixels[:, 0].astype(np.int64) << 16) | (pixels[:, 1].astype(np.int64) << 8) | pixels[:, 2]
+  unique, first, counts = np.unique(packed, return_index=True, return_counts=True)
+  order = np.argsort(first, kind="stable")
+  return unique[order], counts[order]
+
+
+def _lab(colors: Array) -> Array:
+  '''Vectorized lab_from_argb, colors are packed RGB, returns shape (N, 3).'''
+  r = _LINEARIZED[(colors >> 16) & 255]
+  g = _LINEARIZED[(colors >> 8) & 255]
+  b = _LINEARIZED[colors & 255]
+  matrix = _SRGB_TO_XYZ
+  x = matrix[0][0] * r + matrix[0][1] * g + matrix[0][2] * b
+  y = matrix[1][0] * r + matrix[1][1] * g + matrix[1][2] * b
+  z = matrix[2][0] * r + matrix[2][1] * g + matrix[2][2] * b
+  e = 216.0 / 24389.0
+  kappa = 24389.0 / 27.0
+  xyz = np.stack((x / WHITE_POINT_D65[0], y / WHITE_POINT_D65[1], z / WHITE_POINT_D65[2]), 1)
+  f = np.where(xyz > e, np.cbrt(xyz), (kappa * xyz + 16) / 116)
+  return np.stack((116.0 * f[:, 1] - 16, 500.0 * (f[:, 0] - f[:, 1]), 200.0 * (f[:, 1] - f[:, 2])), 1)
+
+
+def wu(colors: Array, counts: Array, max_colors: int) -> List[int]:
+  '''
+  quantizer_wu.quantize with the histogram built by bincount and the moments by cumsum.
+  :param colors: Unique colors, packed RGB.
+  :param counts: Number of pixels of each color.
+  :return: Colors in ARGB format.
+  '''
+  side = quantizer_wu._SIDE_LENGTH  # pyright: ignore[reportPrivateUsage]
+  bits = 8 - quantizer_wu._INDEX_BITS  # pyright: ignore[reportPrivateUsage]
+  red = (colors >> 16) & 255
+  green = (colors >> 8) & 255
+  blue = colors & 255
+  index = ((red >> bits) + 1) * side * side + ((green >> bits) + 1) * side + (blue >> bits) + 1
+  size = side * side * side
+
+  def cumulative(weights: Array) -> List[int]:
+    # computeMoments 就是在三个方向上分别求前缀和
+    volume = np.bincount(index, weights, size).astype(np.int64).reshape(side, side, side)
+    return volume.cumsum(0).cumsum(1).cumsum(2).reshape(-1).tolist()
+
+  return quantizer_wu.quantize_moments(
+    cumulative(counts),
+    cumulative(counts * red),
+    cumulative(counts * green),
+    cumulative(counts * blue),
+    cumulative(counts * (red * red + green * green + blue * blue)),
+    max_colors,
+  )
+
+
+def wsmeans(colors: Array, counts: Array, starting_clusters: List[int], max_colors: int) -> OrderedDict[int, int]:
+  '''
+  quantizer_wsmeans.quantize with distances to all clusters computed at once. The triangle
+  inequality check there only skips clusters that can't be closer, so it isn't needed.
+  :param colors: Unique colors, packed RGB.
+  :param counts: Number of pixels of each color.
+  :return: Map with keys of colors in ARGB format, and values of number of pixels.
+  '''
+  random.seed(69)
+  points = _lab(colors)
+  pointCount = len(points)
+  clusterCount = min(max_colors, pointCount)
+  if starting_clusters:
+    clusterCount = min(clusterCount, len(starting_clusters))
+  if clusterCount == 0:
+    return OrderedDict[int, int]()
+  clusterList = [lab_from_argb(cluster) for cluster in starting_clusters]
+  if not starting_clusters:
+    for _ in range(clusterCount):
+      l = random.uniform(0, 1) * 100.0
+      a = random.uniform(0, 1) * (100.0 - (-100.0) + 1) + -100
+      b = random.uniform(0, 1) * (100.0 - (-100.0) + 1) + -100
+      clusterList.append((l, a, b))
+  clusters = np.array(clusterList, dtype=np.float64).reshape(-1, 3)[:clusterCount]
+  clusterIndices = np.array([math.floor(random.uniform(0, 1) * clusterCount) for _ in range(pointCount)], dtype=np.intp)
+  pixelCountSums = np.zeros(clusterCount, dtype=np.int64)
+  for iteration in range(quantizer_wsmeans._MAX_ITERATIONS):  # pyright: ignore[reportPrivateUsage]
+    # 逐个分量累加，避免生成 (点数, 簇数, 3) 的临时数组
+    distances = np.zeros((pointCount, clusterCount))
+    for i in range(3):
+      distances += (points[:, i, None] - clusters[None, :, i]) ** 2
+    previousDistance = distances[np.arange(pointCount), clusterIndices]
+    newClusterIndex = distances.argmin(1)
+    minimumDistance = distances[np.arange(pointCount), newClusterIndex]
+    moved = (minimumDistance < previousDistance) & (
+      np.abs(np.sqrt(minimumDistance) - np.sqrt(previousDistance)) > quantizer_wsmeans._MIN_MOVEMENT_DISTANCE  # pyright: ignore[reportPrivateUsage]
+    )
+    clusterIndices = np.where(moved, newClusterIndex, clusterIndices)
+    if not moved.any() and iteration != 0:
+      break
+    pixelCountSums = np.bincount(clusterIndices, counts, clusterCount).astype(np.int64)
+    sums = np.stack([np.bincount(clusterIndices, points[:, i] * counts, clusterCount) for i in range(3)], 1)
+    nonEmpty = pixelCountSums > 0
+    clusters = np.zeros_like(clusters)
+    clusters[nonEmpty] = sums[nonEmpty] / pixelCountSums[nonEmpty, None]
+  argbToPopulation = OrderedDict[int, int]()
+  for i in range(clusterCount):
+    count = int(pixelCountSums[i])
+    if count == 0:
+      continue
+    l, a, b = clusters[i].tolist()
+    possibleNewCluster = argb_from_lab(l, a, b)
+    if possibleNewCluster in argbToPopulation:
+      continue
+    argbToPopulation[possibleNewCluster] = count
+  return argbToPopulation
+
+
+def quantize(pixels: Array, max_colors: int) -> OrderedDict[int, int]:
+  '''
+  Same as quantizer_celebi.quantize.
+  :param pixels: Opaque pixels, shape (N, 3), dtype uint8.
+  :param max_colors: The number of colors to divide the image into. A lower number of colors may be
+                     returned.
+  :return: Map with keys of colors in ARGB format, and values of number of pixels in the original
+           image that correspond to the color in the quantized image.
+  '''
+  colors, counts = _dedupe(pixels)
+  return wsmeans(colors, counts, wu(colors, counts, max_colors), max_colors)
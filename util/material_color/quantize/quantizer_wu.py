@@ -291,3 +291,21 @@ def quantize(pixels: Iterable[int], max_colors: int) -> List[int]:
   quantizer.computeMoments()
   createBoxesResult = quantizer.createBoxes(max_colors)
   return quantizer.createResult(createBoxesResult.resultCount)
+
+
+def quantize_moments(weights: List[int], momentsR: List[int], momentsG: List[int], momentsB: List[int], moments: List[int], max_colors: int) -> List[int]:
+  '''
+  Same as quantize, but takes the cumulative moments computed elsewhere (see quantizer_numpy).
+  :param weights: Cumulative pixel counts, indexed by _getIndex.
+  :param max_colors: The number of colors to divide the image into. A lower number of colors may be
+                     returned.
+  :return: Colors in ARGB format.
+  '''
+  quantizer = _QuantizerWu()
+  quantizer.weights = weights
+  quantizer.momentsR = momentsR
+  quantizer.momentsG = momentsG
+  quantizer.momentsB = momentsB
+  quantizer.moments = moments
+  createBoxesResult = quantizer.createBoxes(max_colors)
+  return quantizer.createResult(createBoxesResult.resultCount)
@@ -1,19 +1,24 @@
 import asyncio
 import base64
 import contextvars
+import functools
 import itertools
 import math
 import os
 import random
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from datetime import timedelta
 from enum import Enum
 from html.parser import HTMLParser
 from io import StringIO
 from typing import (
-  TYPE_CHECKING, Any, Callable, Coroutine, Dict, Generator, Iterable, List, Literal, Optional,
-  Sequence, Set, Tuple, TypeVar, Union, overload,
+  TYPE_CHECKING, Any, AsyncIterator, Callable, Coroutine, Dict, Generator, Iterable, List,
+  Literal, Optional, Sequence, Set, Tuple, TypeVar, Union, overload,
 )
+from weakref import WeakValueDictionary
 
 import aiohttp
 import nonebot
@@ -25,19 +30,21 @@ from nonebot.typing import T_State
 from pydantic import BaseModel, Field, RootModel
 from typing_extensions import ParamSpec
 
+from . import configs
 from .configs import SharedConfig
 
 if TYPE_CHECKING:
-  from playwright.async_api import Browser, Playwright as AsyncPlaywright
+  from playwright.async_api import Browser, Page, Playwright as AsyncPlaywright, ViewportSize
 
 
 __all__ = [
   "ADAPTER_NAME", "BROWSER_UA", "AggregateError", "AnyMessage", "CONFIG", "CairoAntialias",
   "CairoHintMetrics", "CairoHintStyle", "CairoSubpixel", "Config", "EnableSet", "Font",
-  "HTMLStripper", "NotCommand", "PromptTimeout", "Quantize", "Resample", "ScaleResample", "any_v",
-  "binomial_sample", "chunked", "command_start", "format_time", "forward_node", "http",
-  "is_command", "is_superuser", "launch_playwright", "local", "prompt", "range_float", "range_int",
-  "send_forward_msg", "superusers", "weighted_choice",
+  "HTMLStripper", "NotCommand", "PromptTimeout", "Quantize", "Resample", "ScaleResample",
+  "acquire_page", "any_v", "binomial_sample", "chunked", "command_start", "evict_directory",
+  "format_time", "forward_node", "http", "is_command", "is_superuser", "launch_playwright",
+  "local", "process_pool", "process_pool_stats", "prompt", "range_float", "range_int",
+  "run_in_process", "send_forward_msg", "superusers", "weighted_choice",
 ]
 
 
@@ -140,21 +147,61 @@ class Config(BaseModel):
   text_subpixel: CairoSubpixel = "default"
   text_hint_metrics: CairoHintMetrics = True
   text_hint_style: CairoHintStyle = "slight"
+  text_cache_size: int = 64 * 1024 * 1024  # 字节，0 为禁用
   libimagequant: bool = False
   quantize: Quantize = "mediancut"
+  gif_palette: Literal["global", "frame"] = "global"  # 所有帧共用调色板或者每帧单独量化
+  gif_palette_samples: int = 8  # 生成全局调色板时抽样的帧数
   dither: bool = True
   backend_local: bool = True
   browser: Literal["chromium", "firefox", "webkit"] = "chromium"
   browser_path: Optional[str] = None
+  browser_max_pages: int = 4  # 同时打开的页面数
+  browser_recycle_pages: int = 100  # 打开这么多页面后换一个新的浏览器，0 为不更换
+  browser_idle_timeout: float = 300  # 秒，空闲这么久后关闭浏览器，0 为不关闭
+  process_pool_size: int = 0  # 0 为 CPU 核心数
+  process_pool_user_limit: int = 4
+  avatar_cache_ttl: int = 3600
+  avatar_cache_size: int = 64 * 1024 * 1024  # 字节，头像磁盘缓存的大小
+  avatar_cache_count: int = 256  # 内存中缓存的已解码头像数量
+  image_cache_size: int = 256 * 1024 * 1024  # 字节，0 为禁用
+  image_max_size: int = 32 * 1024 * 1024  # 字节，0 为不限制
+  state_write_delay: float = 1  # 秒，0 为每次修改立即写入
+  # 修改后已有的 YAML 状态仍然可以读取，可以用 /迁移状态 一次性转换
+  state_storage: configs.StorageName = "yaml"
+  config_watch: bool = True  # 配置和状态文件修改后自动重载
+  config_watch_interval: float = 2  # 没有安装 watchfiles 时检查的间隔
 
 
 CONFIG = SharedConfig("misc", Config)
 ADAPTER_NAME = Adapter.get_name().split(None, 1)[0].lower()
 BROWSER_UA = "Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0"
 _http: Optional[aiohttp.ClientSession] = None
+_process_pool: Optional[ProcessPoolExecutor] = None
+# 没有任务在等待或运行时信号量会被回收，不会一直占用内存
+_process_user_semaphores: "WeakValueDictionary[int, asyncio.Semaphore]" = WeakValueDictionary()
+_config_watcher: "Optional[asyncio.Task[None]]" = None
+_playwright: "Optional[AsyncPlaywright]" = None
+_browser: "Optional[_PooledBrowser]" = None
+_browsers: "Set[_PooledBrowser]" = set()
+_browser_lock: Optional[asyncio.Lock] = None
+_browser_semaphore: Optional[asyncio.Semaphore] = None
+_browser_active = 0
+_browser_idle: Optional[asyncio.TimerHandle] = None
+_browser_idle_task: "Optional[asyncio.Task[None]]" = None
 _driver = nonebot.get_driver()
 
 
+@dataclass
+class ProcessPoolStats:
+  queued: int = 0  # 因为单个用户的并发限制还没有提交的任务
+  pending: int = 0  # 已经提交到进程池但是还没有完成的任务
+  completed: int = 0
+
+
+_process_pool_stats = ProcessPoolStats()
+
+
 def launch_playwright(p: "AsyncPlaywright", **kw: Any) -> Coroutine[Any, Any, "Browser"]:
   config = CONFIG()
   if config.browser == "chromium":
@@ -166,6 +213,130 @@ def launch_playwright(p: "AsyncPlaywright", **kw: Any) -> Coroutine[Any, Any, "B
   return browser.launch(executable_path=config.browser_path, **kw)
 
 
+@dataclass(eq=False)
+class _PooledBrowser:
+  browser: "Browser"
+  opened: int = 0  # 打开过的页面数
+  active: int = 0  # 正在使用的页面数
+
+
+def _forget_browser(pooled: _PooledBrowser) -> None:
+  global _browser
+  _browsers.discard(pooled)
+  if _browser is pooled:
+    _browser = None
+
+
+async def _get_browser() -> _PooledBrowser:
+  global _playwright, _browser, _browser_lock
+  if _browser_lock is None:
+    _browser_lock = asyncio.Lock()
+  async with _browser_lock:
+    if _browser is not None and _browser.browser.is_connected():
+      return _browser
+    if _playwright is None:
+      from playwright.async_api import async_playwright
+      _playwright = await async_playwright().start()
+    browser = await launch_playwright(_playwright)
+    pooled = _PooledBrowser(browser)
+    # 浏览器崩溃或者被关闭后，下次使用时重新启动
+    browser.on("disconnected", lambda _: _forget_browser(pooled))
+    _browser = pooled
+    _browsers.add(pooled)
+    return pooled
+
+
+# force 为 True 时即使还有页面在使用也关闭，用于关闭机器人
+async def _stop_browsers(force: bool = False) -> None:
+  global _playwright, _browser
+  if _browser_lock is None:
+    return
+  async with _browser_lock:
+    # 等待锁的时候可能又有新的页面
+    if _browser_active and not force:
+      return
+    for pooled in list(_browsers):
+      await pooled.browser.close()
+    _browsers.clear()
+    _browser = None
+    if _playwright:
+      await _playwright.stop()
+      _playwright = None
+
+
+def _schedule_stop_browsers() -> None:
+  global _browser_idle, _browser_idle_task
+  _browser_idle = None
+  _browser_idle_task = asyncio.create_task(_stop_browsers())
+
+
+# 从共享的浏览器中打开一个页面，浏览器在第一次使用时启动，空闲一段时间后关闭
+# 每个页面都在单独的上下文中，退出时关闭，不会和其他请求共享 Cookie 等状态
+@asynccontextmanager
+async def acquire_page(
+  viewport: "Optional[ViewportSize]" = None, scale: Optional[float] = None,
+) -> AsyncIterator["Page"]:
+  global _browser, _browser_semaphore, _browser_active, _browser_idle
+  if _browser_semaphore is None:
+    _browser_semaphore = asyncio.Semaphore(CONFIG().browser_max_pages)
+  async with _browser_semaphore:
+    _browser_active += 1
+    if _browser_idle:
+      _browser_idle.cancel()
+      _browser_idle = None
+    try:
+      pooled = await _get_browser()
+      pooled.opened += 1
+      pooled.active += 1
+      recycle = CONFIG().browser_recycle_pages
+      if recycle and pooled.opened >= recycle and _browser is pooled:
+        # 之后的页面在新的浏览器中打开，这个浏览器等页面都关闭后再关闭
+        _browser = None
+      try:
+        context = await pooled.browser.new_context(viewport=viewport, device_scale_factor=scale)
+        try:
+          yield await context.new_page()
+        finally:
+          if pooled.browser.is_connected():
+            await context.close()
+      finally:
+        pooled.active -= 1
+        if pooled is not _browser and not pooled.active:
+          _forget_browser(pooled)
+          if pooled.browser.is_connected():  # 关闭机器人时可能已经被强制关闭
+            await pooled.browser.close()
+    finally:
+      _browser_active -= 1
+      timeout = CONFIG().browser_idle_timeout
+      if not _browser_active and timeout > 0:
+        _browser_idle = asyncio.get_running_loop().call_later(timeout, _schedule_stop_browsers)
+
+
+# 按修改时间从旧到新删除目录中的文件，直到总大小不超过 limit 字节
+# 用作磁盘缓存的 LRU 淘汰，读取缓存时需要更新修改时间，会阻塞，应在线程中调用
+def evict_directory(path: str, limit: int) -> None:
+  entries: List[Tuple[float, int, str]] = []
+  total = 0
+  try:
+    with os.scandir(path) as it:
+      for entry in it:
+        if entry.is_file():
+          stat = entry.stat()
+          entries.append((stat.st_mtime, stat.st_size, entry.path))
+          total += stat.st_size
+  except FileNotFoundError:
+    return
+  entries.sort()
+  for _, size, file in entries:
+    if total <= limit:
+      break
+    try:
+      os.remove(file)
+    except FileNotFoundError:
+      pass
+    total -= size
+
+
 def http() -> aiohttp.ClientSession:
   global _http
   if _http is None:
@@ -173,10 +344,83 @@ def http() -> aiohttp.ClientSession:
   return _http
 
 
+def _warm_up_process() -> None:
+  # 提前导入和初始化，避免每个任务的第一帧都要等待
+  import cairo  # noqa: F401
+  from PIL import Image
+  Image.init()
+
+
+def process_pool() -> ProcessPoolExecutor:
+  global _process_pool
+  if _process_pool is None:
+    size = CONFIG().process_pool_size
+    _process_pool = ProcessPoolExecutor(size or None, initializer=_warm_up_process)
+  return _process_pool
+
+
+def process_pool_stats() -> ProcessPoolStats:
+  return ProcessPoolStats(**vars(_process_pool_stats))
+
+
+# 在共享的进程池中运行 CPU 密集型任务，func 和参数都必须能被 pickle
+# user 不为 None 时同一用户同时运行的任务数不超过 process_pool_user_limit
+async def run_in_process(
+  user: Optional[int], func: Callable[P, T], /, *args: P.args, **kwargs: P.kwargs,
+) -> T:
+  loop = asyncio.get_running_loop()
+  call = functools.partial(func, *args, **kwargs)
+  if user is None:
+    semaphore = None
+  elif (semaphore := _process_user_semaphores.get(user, None)) is None:
+    semaphore = asyncio.Semaphore(CONFIG().process_pool_user_limit)
+    _process_user_semaphores[user] = semaphore
+  _process_pool_stats.queued += 1
+  try:
+    if semaphore:
+      await semaphore.acquire()
+  finally:
+    _process_pool_stats.queued -= 1
+  _process_pool_stats.pending += 1
+  try:
+    return await loop.run_in_executor(process_pool(), call)
+  finally:
+    _process_pool_stats.pending -= 1
+    _process_pool_stats.completed += 1
+    if semaphore:
+      semaphore.release()
+
+
+@CONFIG.onload()
+def onload(prev: Optional[Config], curr: Config) -> None:
+  global _browser_semaphore
+  if prev is None or prev.browser_max_pages != curr.browser_max_pages:
+    # 下次打开页面时按新的数量重新创建，已经在使用的页面仍然归还给旧的
+    _browser_semaphore = None
+  configs.SharedState.write_delay = curr.state_write_delay
+  configs.GroupState.write_delay = curr.state_write_delay
+
+
+@_driver.on_startup
+async def on_startup() -> None:
+  global _config_watcher
+  config = CONFIG()
+  if config.config_watch:
+    _config_watcher = asyncio.create_task(configs.watch(config.config_watch_interval))
+
+
 @_driver.on_shutdown
 async def on_shutdown():
+  if _config_watcher:
+    _config_watcher.cancel()
+  if _browser_idle:
+    _browser_idle.cancel()
+  configs.flush_all()
+  await _stop_browsers(True)
   if _http:
     await _http.close()
+  if _process_pool:
+    _process_pool.shutdown(False, cancel_futures=True)
 
 
 def weighted_choice(choices: List[Union[T, Tuple[T, float]]]) -> T:
@@ -1,25 +1,67 @@
+import asyncio
 import base64
+import glob
 import hashlib
 import json
 import os
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
-from datetime import datetime
-from typing import Any, Dict, List, Optional, Tuple, TypeVar, cast
+from datetime import date, datetime, timedelta
+from typing import (
+  Any, AsyncGenerator, Awaitable, Callable, Dict, List, Literal, Optional, Tuple, TypeVar, Union,
+  cast,
+)
 
 import nonebot
+from loguru import logger
 from nonebot.adapters.onebot.v11 import (
   Event, FriendRecallNoticeEvent, GroupRecallNoticeEvent, Message, MessageEvent, MessageSegment,
 )
 from nonebot.message import event_preprocessor
+from pydantic import BaseModel, Field
 from pydantic.json import pydantic_encoder
+from sqlalchemy import Index, Table, and_, event, false, or_, true
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.engine import Connection, Inspector
 from sqlalchemy.engine.interfaces import ReflectedColumn
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.orm import InstrumentedAttribute
-from sqlalchemy.sql.ddl import DDL
-from sqlmodel import Field as SQLField, MetaData, SQLModel as BaseSQLModel, inspect, select, col
+from sqlalchemy.sql.ddl import DDL, CreateTable
+from sqlalchemy.sql.elements import ColumnElement
+from sqlmodel import (
+  Field as SQLField, MetaData, SQLModel as BaseSQLModel, col, delete, func, inspect, select,
+)
+
+from util import configs, hook, misc
+
+nonebot.require("nonebot_plugin_apscheduler")
+from nonebot_plugin_apscheduler import scheduler  # noqa: E402
+
+
+class Retention(BaseModel):
+  # 以下均为天数，0 为永久保留
+  default: int = 0
+  groups: Dict[int, int] = Field(default_factory=dict)
+  cache: int = 0
+  archive: bool = True  # 为 False 时过期消息直接删除而不是移到 archive 目录
+  hour: int = 4
+  vacuum_pages: int = 0  # 每次回收的空闲页数，0 为全部
+
+
+class Config(BaseModel):
+  batch_size: int = 100
+  batch_interval: float = 5
+  max_pending: int = 1000
+  flush_retries: int = 5  # 写入失败时的重试次数，超过后丢弃这一批
+  synchronous: Literal["off", "normal", "full", "extra"] = "normal"
+  cache_size: int = -16384  # 负数的单位为 KiB，即 16 MiB
+  mmap_size: int = 256 * 1024 * 1024
+  retention: Retention = Field(default_factory=Retention)
+
 
-from util import hook
+CONFIG = configs.SharedConfig("record", Config)
 
 
 class SQLModel(BaseSQLModel):
@@ -27,6 +69,13 @@ class SQLModel(BaseSQLModel):
 
 
 class Received(SQLModel, table=True):
+  __table_args__ = (
+    Index("ix_received_group_id_time", "group_id", "time"),
+    Index("ix_received_user_id_time", "user_id", "time"),
+    Index("ix_received_message_id", "message_id"),
+    {"sqlite_autoincrement": True},  # 删除最新的消息后不重复使用 ID，词云按 ID 增量分词
+  )
+
   id: Optional[int] = SQLField(primary_key=True, default=None)
   message_id: int  # 我是做梦也没想到 go-cqhttp 的消息 ID 居然会重复（）
   time: datetime
@@ -37,6 +86,12 @@ class Received(SQLModel, table=True):
 
 
 class Sent(SQLModel, table=True):
+  __table_args__ = (
+    Index("ix_sent_message_id", "message_id"),
+    Index("ix_sent_caused_by", "caused_by"),
+    Index("ix_sent_time", "time"),
+  )
+
   id: Optional[int] = SQLField(primary_key=True, default=None)
   message_id: int
   time: datetime
@@ -54,21 +109,72 @@ class Cache(SQLModel, table=True):
   last_seen: datetime
 
 
+class DailyCount(SQLModel, table=True):
+  __table_args__ = (
+    Index("ix_dailycount_group_id_day", "group_id", "day"),
+    Index("ix_dailycount_user_id_day", "user_id", "day"),
+  )
+
+  day: date = SQLField(primary_key=True)
+  group_id: int = SQLField(primary_key=True)  # 私聊为 -1
+  user_id: int = SQLField(primary_key=True)
+  count: int
+
+
 class Version(SQLModel, table=True):
   version: int = SQLField(primary_key=True)
 
 
+# 按月归档的数据库与主数据库结构相同，ATTACH 为 archive 后通过以下的表访问
+archive_metadata = MetaData(schema="archive")
+ArchivedReceived = cast(Table, cast(Any, Received).__table__.to_metadata(archive_metadata))
+ArchivedSent = cast(Table, cast(Any, Sent).__table__.to_metadata(archive_metadata))
+ARCHIVE_DIR = "states/messages/archive"
+
+
 @dataclass
 class CacheEntry:
   type: str
   md5: str
 
 
+@dataclass
+class PendingRecord:
+  caches: List[CacheEntry]
+  row: Union[Received, Sent]
+  attempts: int = 0  # 写入失败的次数
+
+
+def _create_engine(readonly: bool) -> AsyncEngine:
+  engine = create_async_engine("sqlite+aiosqlite:///states/messages/messages.db")
+
+  @event.listens_for(engine.sync_engine, "connect")
+  def on_connect(dbapi_connection: Any, connection_record: Any) -> None:
+    config = CONFIG()
+    cursor = dbapi_connection.cursor()
+    # WAL 模式下读不阻塞写，统计和词云的长查询不会卡住消息记录
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={config.synchronous}")
+    cursor.execute(f"PRAGMA cache_size={config.cache_size:d}")
+    cursor.execute(f"PRAGMA mmap_size={config.mmap_size:d}")
+    if readonly:
+      cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+  return engine
+
+
 os.makedirs("states/messages", exist_ok=True)
-engine = create_async_engine("sqlite+aiosqlite:///states/messages/messages.db")
+engine = _create_engine(False)
+read_engine = _create_engine(True)  # 只用于统计等耗时的只读查询
 driver = nonebot.get_driver()
 T = TypeVar("T")
-CURRENT_VERSION = 1
+_pending: List[PendingRecord] = []
+_pending_changed = asyncio.Condition()
+_batch_full = asyncio.Event()
+_flush_lock = asyncio.Lock()
+_flusher: Optional["asyncio.Task[None]"] = None
+_before_archive_hooks: List[Callable[[], Awaitable[None]]] = []
 
 
 def _get_columns(inspector: Inspector, table: str) -> Dict[str, ReflectedColumn]:
@@ -103,11 +209,80 @@ def _upgrade_0to1(connection: Connection) -> None:
       _append_column(connection, deleted_by)
 
 
+def _upgrade_1to2(connection: Connection) -> None:
+  # 版本 1：Received 和 Sent 表只有主键，没有索引
+  tables = set(inspect(connection).get_table_names())
+  for model in (Received, Sent):
+    if cast(str, model.__tablename__) in tables:
+      for index in cast(Any, model).__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def _add_daily_counts(connection: Connection, received: Table) -> None:
+  day = func.date(received.c.time)
+  group_id = func.coalesce(received.c.group_id, -1)
+  user_id = received.c.user_id
+  statement = insert(DailyCount).from_select(
+    ["day", "group_id", "user_id", "count"],
+    # 不加 WHERE 的话 SQLite 会把 ON CONFLICT 的 ON 当成 JOIN 的一部分
+    select(day, group_id, user_id, func.count()).where(true()).group_by(day, group_id, user_id),
+  )
+  connection.execute(statement.on_conflict_do_update(
+    index_elements=[DailyCount.day, DailyCount.group_id, DailyCount.user_id],
+    set_={"count": col(DailyCount.count) + statement.excluded["count"]},
+  ))
+
+
+def _upgrade_2to3(connection: Connection) -> None:
+  # 版本 2：没有 DailyCount 表，从 Received 表回填
+  tables = set(inspect(connection).get_table_names())
+  cast(Any, DailyCount).__table__.create(connection, checkfirst=True)
+  if cast(str, Received.__tablename__) in tables:
+    _add_daily_counts(connection, cast(Any, Received).__table__)
+
+
+def _upgrade_3to4(connection: Connection) -> None:
+  # 版本 3：Received 表的主键没有 AUTOINCREMENT，SQLite 不能修改主键，只能重建表
+  if (received := cast(str, Received.__tablename__)) not in inspect(connection).get_table_names():
+    return
+  table = cast(Table, cast(Any, Received).__table__)
+  temp = table.to_metadata(MetaData(), name=f"{received}_new")
+  connection.execute(CreateTable(temp))
+  connection.execute(temp.insert().from_select(list(table.c.keys()), select(table)))
+  connection.execute(DDL(f"DROP TABLE {received}"))
+  connection.execute(DDL(f"ALTER TABLE {temp.name} RENAME TO {received}"))
+  for index in table.indexes:
+    index.create(connection)
+
+
+def _get_version(connection: Connection) -> int:
+  if cast(str, Version.__tablename__) not in inspect(connection).get_table_names():
+    return 0
+  return connection.execute(select(func.max(Version.version))).scalar() or 0
+
+
+# MIGRATIONS[i] 把数据库从版本 i 升级到版本 i + 1，新版本只需在末尾追加
+MIGRATIONS: List[Callable[[Connection], None]] = [
+  _upgrade_0to1, _upgrade_1to2, _upgrade_2to3, _upgrade_3to4,
+]
+CURRENT_VERSION = len(MIGRATIONS)
+
+
 @driver.on_startup
 async def on_startup():
   async with engine.begin() as connection:
-    await connection.run_sync(_upgrade_0to1)
+    version = await connection.run_sync(_get_version)
+    if version > CURRENT_VERSION:
+      raise RuntimeError(f"消息数据库版本 {version} 高于当前支持的版本 {CURRENT_VERSION}")
+    begin = time.perf_counter()
+    for upgrade in MIGRATIONS[version:]:
+      await connection.run_sync(upgrade)
     await connection.run_sync(Received.metadata.create_all)
+    if version < CURRENT_VERSION:
+      logger.info((
+        f"消息数据库从版本 {version} 升级到 {CURRENT_VERSION}，"
+        f"耗时 {time.perf_counter() - begin:.3f} 秒"
+      ))
     async with AsyncSession(connection) as session:
       result = (await session.execute(select(Version))).scalars().all()
       if result:
@@ -118,6 +293,21 @@ async def on_startup():
       else:
         session.add(Version(version=CURRENT_VERSION))
       await session.commit()
+  global _flusher
+  _flusher = asyncio.create_task(_flush_loop())
+  scheduler.add_job(
+    try_apply_retention, "cron", id="record_retention", replace_existing=True,
+    hour=CONFIG().retention.hour,
+  )
+
+
+@driver.on_shutdown
+async def on_shutdown():
+  if _flusher:
+    _flusher.cancel()
+  await flush()
+  await read_engine.dispose()
+  await engine.dispose()
 
 
 def process_segment(segment: MessageSegment) -> List[CacheEntry]:
@@ -155,15 +345,270 @@ def serialize_message(message: Message) -> Tuple[List[CacheEntry], str]:
 
 
 async def process_caches(session: AsyncSession, caches: List[CacheEntry]) -> None:
-  for cache in caches:
-    result = await session.execute(select(Cache).where(Cache.md5 == cache.md5))
-    item = result.scalar_one_or_none()
-    now = datetime.now()
-    if not item:
-      item = Cache(md5=cache.md5, type=cache.type, created=now, last_seen=now)
+  now = datetime.now()
+  entries = {cache.md5: cache for cache in caches}
+  # 旧版 SQLite 每条语句最多 999 个参数，每行 4 个
+  for chunk in misc.chunked(entries.values(), 200):
+    statement = insert(Cache).values([
+      {"md5": cache.md5, "type": cache.type, "created": now, "last_seen": now}
+      for cache in chunk
+    ])
+    await session.execute(statement.on_conflict_do_update(
+      index_elements=[Cache.md5], set_={"last_seen": statement.excluded.last_seen},
+    ))
+
+
+async def add_caches(caches: List[CacheEntry]) -> None:
+  if not caches:
+    return
+  async with AsyncSession(engine) as session:
+    await process_caches(session, caches)
+    await session.commit()
+
+
+async def _enqueue(caches: List[CacheEntry], row: Union[Received, Sent]) -> None:
+  # 写入缓冲区而非直接写数据库，由 _flush_loop 按数量或时间批量提交
+  config = CONFIG()
+  async with _pending_changed:
+    await _pending_changed.wait_for(lambda: len(_pending) < config.max_pending)
+    _pending.append(PendingRecord(caches, row))
+    if len(_pending) >= config.batch_size:
+      _batch_full.set()
+
+
+async def process_daily_counts(session: AsyncSession, rows: List[Received]) -> None:
+  counts = Counter(
+    (row.time.date(), -1 if row.group_id is None else row.group_id, row.user_id) for row in rows
+  )
+  for chunk in misc.chunked(counts.items(), 200):
+    statement = insert(DailyCount).values([
+      {"day": day, "group_id": group_id, "user_id": user_id, "count": count}
+      for (day, group_id, user_id), count in chunk
+    ])
+    await session.execute(statement.on_conflict_do_update(
+      index_elements=[DailyCount.day, DailyCount.group_id, DailyCount.user_id],
+      set_={"count": col(DailyCount.count) + statement.excluded["count"]},
+    ))
+
+
+async def _write(batch: List[PendingRecord]) -> None:
+  rows = [item.row for item in batch]
+  async with AsyncSession(engine) as session:
+    await process_caches(session, [cache for item in batch for cache in item.caches])
+    await process_daily_counts(session, [row for row in rows if isinstance(row, Received)])
+    session.add_all(rows)
+    await session.commit()
+
+
+async def _flush() -> Optional[float]:
+  # 写入失败时把这一批放回缓冲区开头，返回重试前需要等待的秒数
+  if not _pending:
+    return None
+  batch = _pending[:]
+  _pending.clear()
+  _batch_full.clear()
+  async with _pending_changed:
+    _pending_changed.notify_all()
+  try:
+    await _write(batch)
+    return None
+  except Exception:
+    logger.exception(f"写入 {len(batch)} 条消息记录失败")
+  retries = CONFIG().flush_retries
+  for item in batch:
+    item.attempts += 1
+  dropped = [item for item in batch if item.attempts > retries]
+  if dropped:
+    rows = ", ".join(f"{type(item.row).__name__}({item.row.message_id})" for item in dropped)
+    logger.error(f"重试 {retries} 次后仍然无法写入，丢弃了 {len(dropped)} 条消息记录: {rows}")
+  batch = [item for item in batch if item.attempts <= retries]
+  if not batch:
+    return None
+  _pending[:0] = batch
+  return min(0.5 * 2 ** (max(item.attempts for item in batch) - 1), 10)
+
+
+# 读取刚收发的消息之前应该先调用
+async def flush() -> None:
+  # 等待重试时不持有锁，不会阻塞其他调用者
+  while True:
+    async with _flush_lock:
+      delay = await _flush()
+    if delay is None:
+      return
+    await asyncio.sleep(delay)
+
+
+async def rebuild_daily_counts() -> None:
+  async with _flush_lock:
+    await _flush()
+    async with engine.connect() as connection:
+      await connection.execute(cast(Any, DailyCount).__table__.delete())
+      await connection.run_sync(_add_daily_counts, cast(Any, Received).__table__)
+      await connection.commit()
+      for path in get_archives():
+        async with attach_archive(connection, path):
+          await connection.run_sync(_add_daily_counts, ArchivedReceived)
+          await connection.commit()
+
+
+def get_archives() -> List[str]:
+  return sorted(glob.glob(os.path.join(ARCHIVE_DIR, "*.db")))
+
+
+@asynccontextmanager
+async def attach_archive(
+  connection: AsyncConnection, path: str,
+) -> AsyncGenerator[None, None]:
+  # SQLite 不能在事务中 ATTACH 或 DETACH，调用者需要在退出前自行提交
+  await connection.exec_driver_sql("ATTACH DATABASE ? AS archive", (path,))
+  try:
+    await connection.run_sync(archive_metadata.create_all)
+    yield
+  finally:
+    await connection.rollback()
+    await connection.exec_driver_sql("DETACH DATABASE archive")
+
+
+# 归档前调用，用于处理即将从主数据库移走的消息
+def before_archive(callback: Callable[[], Awaitable[None]]) -> Callable[[], Awaitable[None]]:
+  _before_archive_hooks.append(callback)
+  return callback
+
+
+def _expired(
+  retention: Retention, now: datetime, time: Any, group_id: Optional[Any],
+) -> ColumnElement[bool]:
+  # group_id 为 None 表示私聊，只使用默认的保留天数
+  conditions: List[ColumnElement[bool]] = []
+  if group_id is not None:
+    for group, days in retention.groups.items():
+      if days:
+        conditions.append(and_(group_id == group, time < now - timedelta(days)))
+  if retention.default:
+    condition = time < now - timedelta(retention.default)
+    if group_id is not None:
+      condition = and_(
+        or_(group_id.is_(None), group_id.not_in(list(retention.groups))), condition,
+      )
+    conditions.append(condition)
+  return or_(false(), *conditions)
+
+
+async def _delete_expired(
+  connection: AsyncConnection, received: ColumnElement[bool], sent: ColumnElement[bool],
+) -> int:
+  result = await connection.execute(delete(Received).where(received))
+  total = result.rowcount
+  result = await connection.execute(delete(Sent).where(sent))
+  return total + result.rowcount
+
+
+async def _archive(retention: Retention) -> int:
+  now = datetime.now()
+  expired_received = _expired(retention, now, col(Received.time), col(Received.group_id))
+  expired_sent = or_(
+    and_(
+      col(Sent.is_group).is_(True),
+      _expired(retention, now, col(Sent.time), col(Sent.target_id)),
+    ),
+    and_(col(Sent.is_group).is_(False), _expired(retention, now, col(Sent.time), None)),
+  )
+  month = func.strftime("%Y-%m", Received.time)
+  sent_month = func.strftime("%Y-%m", Sent.time)
+  total = 0
+  async with engine.connect() as connection:
+    months = set((await connection.execute(
+      select(month).where(expired_received).distinct(),
+    )).scalars())
+    months.update((await connection.execute(
+      select(sent_month).where(expired_sent).distinct(),
+    )).scalars())
+    for current in sorted(months):
+      received_condition = and_(expired_received, month == current)
+      sent_condition = and_(expired_sent, sent_month == current)
+      if retention.archive:
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        async with attach_archive(connection, os.path.join(ARCHIVE_DIR, f"{current}.db")):
+          # WAL 模式下跨数据库的事务不是原子的，上次可能已经归档但没有删除，忽略重复的行
+          await connection.execute(ArchivedReceived.insert().prefix_with("OR IGNORE").from_select(
+            list(ArchivedReceived.c.keys()), select(Received).where(received_condition),
+          ))
+          await connection.execute(ArchivedSent.insert().prefix_with("OR IGNORE").from_select(
+            list(ArchivedSent.c.keys()), select(Sent).where(sent_condition),
+          ))
+          total += await _delete_expired(connection, received_condition, sent_condition)
+          await connection.commit()
+      else:
+        total += await _delete_expired(connection, received_condition, sent_condition)
+        await connection.commit()
+  return total
+
+
+async def _prune_caches(days: int) -> int:
+  expired = col(Cache.last_seen) < datetime.now() - timedelta(days)
+  async with engine.begin() as connection:
+    result = await connection.execute(select(Cache.md5, Cache.type).where(expired))
+    caches = result.all()
+    await connection.execute(delete(Cache).where(expired))
+  for md5, type in caches:
+    try:
+      os.remove(f"states/messages/{type}/{md5}")
+    except FileNotFoundError:
+      pass
+  return len(caches)
+
+
+def _retention_enabled(retention: Retention) -> bool:
+  return bool(retention.default or any(retention.groups.values()) or retention.cache)
+
+
+async def _vacuum(pages: int) -> None:
+  async with engine.connect() as connection:
+    connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+    result = await connection.exec_driver_sql("PRAGMA auto_vacuum")
+    if result.scalar() != 2:  # 2 为 INCREMENTAL
+      # 只在第一次清理时转换，需要完整 VACUUM 一次，很慢并且临时占用约两倍的磁盘空间
+      logger.info("正在启用消息数据库的增量 VACUUM，需要完整 VACUUM 一次，可能需要较长时间")
+      begin = time.perf_counter()
+      await connection.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+      await connection.exec_driver_sql("VACUUM")
+      logger.info(f"启用增量 VACUUM 完成，耗时 {time.perf_counter() - begin:.3f} 秒")
+    elif pages:
+      await connection.exec_driver_sql(f"PRAGMA incremental_vacuum({pages:d})")
     else:
-      item.last_seen = now
-    session.add(item)
+      await connection.exec_driver_sql("PRAGMA incremental_vacuum")
+
+
+async def apply_retention() -> None:
+  retention = CONFIG().retention
+  if not _retention_enabled(retention):
+    return
+  for callback in _before_archive_hooks:
+    await callback()
+  # 持有锁直到 VACUUM 结束，避免后台写入因为数据库被锁而失败
+  async with _flush_lock:
+    await _flush()
+    archived = await _archive(retention)
+    pruned = await _prune_caches(retention.cache) if retention.cache else 0
+    await _vacuum(retention.vacuum_pages)
+  logger.info(f"归档了 {archived} 条过期消息，清理了 {pruned} 个过期缓存")
+
+
+async def try_apply_retention() -> None:
+  try:
+    await apply_retention()
+  except Exception:
+    logger.exception("清理消息数据库失败")
+
+
+async def _flush_loop() -> None:
+  while True:
+    try:
+      await asyncio.wait_for(_batch_full.wait(), CONFIG().batch_interval)
+    except asyncio.TimeoutError:
+      pass
+    await asyncio.shield(flush())  # 关闭时取消任务不能打断正在进行的写入
 
 
 @hook.on_message_sent
@@ -176,23 +621,21 @@ async def on_message_sent(
   if isinstance(event, MessageEvent) and event.message_id:
     caused_by = event.message_id
   caches, segments = serialize_message(message.copy())
-  async with AsyncSession(engine) as session:
-    await process_caches(session, caches)
-    session.add(Sent(
-      message_id=message_id,
-      time=datetime.now(),
-      is_group=is_group,
-      target_id=target_id,
-      content=segments,
-      caused_by=caused_by,
-    ))
-    await session.commit()
+  await _enqueue(caches, Sent(
+    message_id=message_id,
+    time=datetime.now(),
+    is_group=is_group,
+    target_id=target_id,
+    content=segments,
+    caused_by=caused_by,
+  ))
 
 
 @event_preprocessor
 async def on_message_event(event: Event) -> None:
   # 类型标注得是 Event，不然 DEBUG 日志会被 HeartbeatEvent 刷屏
   if isinstance(event, GroupRecallNoticeEvent):
+    await flush()  # 被撤回的消息可能还在缓冲区里
     async with AsyncSession(engine) as session:
       if event.user_id == event.self_id:
         result = await session.execute(select(Sent).where(
@@ -211,6 +654,7 @@ async def on_message_event(event: Event) -> None:
         session.add(record)
       await session.commit()
   elif isinstance(event, FriendRecallNoticeEvent):
+    await flush()
     async with AsyncSession(engine) as session:
       result = await session.execute(select(Received).where(
         Received.message_id == event.message_id,
@@ -233,13 +677,10 @@ async def on_message_event(event: Event) -> None:
     if not event.message_id:
       return
     caches, segments = serialize_message(event.message)
-    async with AsyncSession(engine) as session:
-      await process_caches(session, caches)
-      session.add(Received(
-        message_id=event.message_id,
-        time=datetime.fromtimestamp(event.time),
-        user_id=event.user_id,
-        group_id=getattr(event, "group_id", None),
-        content=segments,
-      ))
-      await session.commit()
+    await _enqueue(caches, Received(
+      message_id=event.message_id,
+      time=datetime.fromtimestamp(event.time),
+      user_id=event.user_id,
+      group_id=getattr(event, "group_id", None),
+      content=segments,
+    ))
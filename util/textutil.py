@@ -1,5 +1,7 @@
 import math
-from typing import Any, Dict, Literal, Optional, Tuple, Union, cast, overload
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Literal, Optional, Tuple, Union, cast, overload
 
 import cairo
 import gi
@@ -64,14 +66,79 @@ HINT_STYLES: Dict[misc.CairoHintStyle, cairo.HintStyle] = {
 }
 
 
+class RenderCache:
+  def __init__(self) -> None:
+    self._items: OrderedDict[Hashable, Image.Image] = OrderedDict()
+    self._lock = threading.Lock()  # render 通常在 to_thread 里调用
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+
+  @staticmethod
+  def _size(im: Image.Image) -> int:
+    return im.width * im.height * len(im.getbands())
+
+  def get(self, key: Hashable) -> Optional[Image.Image]:
+    with self._lock:
+      im = self._items.get(key, None)
+      if im is None:
+        self.misses += 1
+        return None
+      self._items.move_to_end(key)
+      self.hits += 1
+    return im.copy()  # 调用者可能会修改图片
+
+  def put(self, key: Hashable, im: Image.Image) -> None:
+    limit = misc.CONFIG().text_cache_size
+    size = self._size(im)
+    if not limit or size > limit:
+      return
+    with self._lock:
+      if key in self._items:
+        return
+      self._items[key] = im.copy()
+      self.bytes += size
+      while self.bytes > limit:
+        _, old = self._items.popitem(False)
+        self.bytes -= self._size(old)
+
+  def clear(self) -> None:
+    with self._lock:
+      self._items.clear()
+      self.bytes = 0
+
+
+RENDER_CACHE = RenderCache()
+_local = threading.local()
+
+
+@misc.CONFIG.onload()
+def onload(prev: Optional[misc.Config], curr: misc.Config) -> None:
+  RENDER_CACHE.clear()  # 字体替换和渲染选项可能变了
+
+
+def _shared_context() -> Pango.Context:
+  # Pango.Context 不是线程安全的，每个线程共享一个
+  config = misc.CONFIG()
+  if getattr(_local, "config", None) is not config:
+    _local.context = Pango.Context()
+    _local.context.set_font_map(PangoCairo.FontMap.get_default())
+    font_options(_local.context)
+    _local.config = config
+  return _local.context
+
+
 class RichText:
   _IMAGE_REPLACEMENT = "￼".encode()
 
-  def __init__(self) -> None:
-    self._context = Pango.Context()
-    self._context.set_font_map(PangoCairo.FontMap.get_default())
-    font_options(self._context)
-    PangoCairo.context_set_shape_renderer(self._context, self._render_images)
+  def __init__(self, context: Optional[Pango.Context] = None) -> None:
+    # 共享的 context 没有 shape renderer，不能 append_image
+    if context is None:
+      context = Pango.Context()
+      context.set_font_map(PangoCairo.FontMap.get_default())
+      font_options(context)
+      PangoCairo.context_set_shape_renderer(context, self._render_images)
+    self._context = context
     self._utf8 = bytearray()
     self._attrs = Pango.AttrList()
     self._images: Dict[int, cairo.ImageSurface] = {}
@@ -219,7 +286,13 @@ def layout(
   ellipsize: Ellipsize = None, markup: bool = False, align: Align = "l", spacing: int = 0,
   lines: int = 0,
 ) -> Layout:
-  render = RichText().set_font(font, size).set_wrap(wrap).set_align(align).set_spacing(spacing)
+  render = (
+    RichText(_shared_context())
+    .set_font(font, size)
+    .set_wrap(wrap)
+    .set_align(align)
+    .set_spacing(spacing)
+  )
   if box:
     render.set_width(box)
   if lines:
@@ -251,9 +324,18 @@ def render(
   stroke_color: imutil.Color = (255, 255, 255), **kw: Any,
 ) -> Image.Image:
   if isinstance(content, Layout):
-    l = content
-  else:
-    l = layout(content, *args, **kw)
+    return _render(content, color, stroke, stroke_color)
+  key = (content, args, tuple(sorted(kw.items())), color, stroke, stroke_color)
+  if (im := RENDER_CACHE.get(key)) is not None:
+    return im
+  im = _render(layout(content, *args, **kw), color, stroke, stroke_color)
+  RENDER_CACHE.put(key, im)
+  return im
+
+
+def _render(
+  l: Layout, color: imutil.Color, stroke: float, stroke_color: imutil.Color,
+) -> Image.Image:
   _, rect = l.get_pixel_extents()
   margin = math.ceil(stroke)
   x = -rect.x + margin
@@ -1,5 +1,7 @@
 import asyncio
+import hashlib
 import itertools
+import os
 import re
 import ssl
 import time
@@ -69,6 +71,13 @@ LINK_RE = re.compile(r"^https?://.+$")
 IMAGE_RE = re.compile(r"^\[CQ:image[^\]]+\]$")
 SSL_CONTEXT = ssl.create_default_context()
 SSL_CONTEXT.set_ciphers("DEFAULT")
+IMAGE_DIR = "states/images"
+IMAGE_MD5_RE = re.compile(r"^([0-9a-fA-F]{32})(?:\.image)?$")
+_image_tasks: Dict[str, "asyncio.Task[bytes]"] = {}
+
+
+class ImageTooLargeError(Exception):
+  pass
 
 
 @CONFIG.onload()
@@ -182,11 +191,76 @@ async def match_uid(
   return matches[0].uids[0]
 
 
+def get_image_md5(data: Dict[str, Any]) -> Optional[str]:
+  # QQ 图片消息段的 file 是图片的 MD5，record 保存的图片也用 MD5 命名
+  if match := IMAGE_MD5_RE.match(data.get("file", "")):
+    return match[1].lower()
+  return None
+
+
+def _read_image(path: str, md5: Optional[str]) -> Optional[bytes]:
+  try:
+    with open(path, "rb") as f:
+      data = f.read()
+  except FileNotFoundError:
+    pass
+  else:
+    os.utime(path)  # 按修改时间淘汰，命中时刷新
+    return data
+  if md5:
+    try:
+      with open(f"states/messages/image/{md5}", "rb") as f:
+        return f.read()
+    except FileNotFoundError:
+      pass
+  return None
+
+
+def _write_image(path: str, data: bytes, limit: int) -> None:
+  os.makedirs(IMAGE_DIR, exist_ok=True)
+  with open(path + ".tmp", "wb") as f:
+    f.write(data)
+  os.replace(path + ".tmp", path)
+  misc.evict_directory(IMAGE_DIR, limit)
+
+
+async def _fetch_image(key: str, url: str, md5: Optional[str]) -> bytes:
+  config = misc.CONFIG()
+  path = os.path.join(IMAGE_DIR, key)
+  if (data := await misc.to_thread(_read_image, path, md5)) is not None:
+    return data
+  chunks: List[bytes] = []
+  async with misc.http().get(url, ssl_context=SSL_CONTEXT) as response:
+    response.raise_for_status()
+    size = response.content_length or 0
+    if config.image_max_size and size > config.image_max_size:
+      raise ImageTooLargeError
+    size = 0
+    async for chunk in response.content.iter_chunked(65536):
+      size += len(chunk)
+      if config.image_max_size and size > config.image_max_size:
+        raise ImageTooLargeError
+      chunks.append(chunk)
+  data = b"".join(chunks)
+  if config.image_cache_size:
+    await misc.to_thread(_write_image, path, data, config.image_cache_size)
+  return data
+
+
+async def download_image_data(url: str, *, md5: Optional[str] = None) -> bytes:
+  key = md5 or "url_" + hashlib.sha1(url.encode()).hexdigest()
+  # 合并同一张图片的并发请求，比如多个 AvatarGetter 任务都回复了同一张图
+  if (task := _image_tasks.get(key, None)) is None:
+    task = _image_tasks[key] = asyncio.create_task(_fetch_image(key, url, md5))
+    task.add_done_callback(lambda _: _image_tasks.pop(key, None))
+  return await asyncio.shield(task)
+
+
 async def download_image(
   url: str, *, crop: bool = True, raw: bool = False, bg: Union[Tuple[int, int, int], bool] = False,
+  md5: Optional[str] = None,
 ) -> Image.Image:
-  async with misc.http().get(url, ssl_context=SSL_CONTEXT) as response:
-    data = await response.read()
+  data = await download_image_data(url, md5=md5)
 
   def process() -> Image.Image:
     image = Image.open(BytesIO(data))
@@ -205,6 +279,8 @@ async def get_image_from_link(url: str, **kw: Any) -> Image.Image:
     return await asyncio.wait_for(download_image(url, **kw), 10)
   except asyncio.TimeoutError as e:
     raise misc.AggregateError(f"下载图片超时：{url}") from e
+  except ImageTooLargeError as e:
+    raise misc.AggregateError(f"图片太大：{url}") from e
   except aiohttp.ClientError as e:
     raise misc.AggregateError(f"下载图片失败：{url}") from e
   except Exception as e:
@@ -233,14 +309,16 @@ async def _get_image_and_user(
     if not event.reply:
       raise misc.AggregateError("它是什么？你得回复一张图片")
     url = ""
+    md5 = None
     for seg in event.reply.message:
       if seg.type == "image":
         if url:
           raise misc.AggregateError("回复的消息有不止一张图片")
         url = seg.data["url"]
+        md5 = get_image_md5(seg.data)
     if not url:
       raise misc.AggregateError("回复的消息没有图片")
-    return await download_image(url, **kw), None
+    return await download_image(url, md5=md5, **kw), None
   if not pattern:
     if default == DefaultType.TARGET:
       if event.reply:
@@ -249,7 +327,8 @@ async def _get_image_and_user(
           reply_sender = reply_msg["sender"]["user_id"]
           for seg in TypeAdapter(Message).validate_python(reply_msg["message"]):
             if seg.type == "image":
-              return await get_image_from_link(seg.data["url"], **kw), None
+              md5 = get_image_md5(seg.data)
+              return await get_image_from_link(seg.data["url"], md5=md5, **kw), None
         except (ActionFailed, ValidationError):
           reply_sender = event.reply.sender.user_id
         uid = reply_sender or event.self_id
@@ -262,7 +341,8 @@ async def _get_image_and_user(
       raise misc.AggregateError("不支持@全体成员，恭喜你浪费了一次")
     uid = int(match[1])
   elif IMAGE_RE.match(pattern):
-    return await get_image_from_link(Message(pattern)[0].data["url"], **kw), None
+    seg = Message(pattern)[0]
+    return await get_image_from_link(seg.data["url"], md5=get_image_md5(seg.data), **kw), None
   elif match := LINK_RE.match(pattern):
     return await get_image_from_link(pattern, **kw), None
   elif pattern in {"~", "自己", "我"}: